@@ -0,0 +1,53 @@
+"""
+In-process ASGI websocket connections for the benchmarks, no network and no server needed.
+"""
+import asyncio
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+
+def load_application():
+    # practicode_backend.asgi sets django up, templates and the database are found relative to the repo
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'practicode_backend.settings')
+    from practicode_backend.asgi import application
+    return application
+
+
+class Connection:
+    # the client side of a websocket, the application handles it in a task
+    def __init__(self, application, path: str, query: str):
+        self.inbox = asyncio.Queue()
+        self.outbox = asyncio.Queue()
+        scope = {
+            'type': 'websocket',
+            'path': path,
+            'raw_path': path,
+            'query_string': query.encode(),
+            'headers': [],
+            'client': ('127.0.0.1', 1),
+            'scheme': 'ws',
+        }
+        self.inbox.put_nowait({'type': 'websocket.connect'})
+        self.task = asyncio.create_task(application(scope, self.inbox.get, self.outbox.put))
+
+    async def accepted(self) -> bool:
+        return (await self.outbox.get())['type'] == 'websocket.accept'
+
+    def send(self, text: str):
+        self.inbox.put_nowait({'type': 'websocket.receive', 'text': text})
+
+    def close(self):
+        self.inbox.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+
+    async def receive(self) -> str:
+        # None once the application has closed the connection
+        while True:
+            event = await self.outbox.get()
+            if event['type'] == 'websocket.send':
+                return event.get('text')
+            if event['type'] == 'websocket.close':
+                return None
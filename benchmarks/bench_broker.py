@@ -0,0 +1,103 @@
+"""
+Relay throughput through the broker hub as server processes are added.
+
+Every process registers echo workers and runs clients that exchange messages with whatever
+worker the hub dispatches them to, so most of the traffic crosses process boundaries.
+The first line is the in-process WorkersManager with the same per-process load.
+
+Usage: python benchmarks/bench_broker.py [max_processes] [clients_per_process] [messages_per_client]
+"""
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from practicode_backend import broker, workers
+
+WORKERS_PER_PROCESS = 4
+SLOTS = 16
+
+
+async def echo_worker(manager, worker_id: str):
+    while True:
+        msg = await manager.receive_for_worker(worker_id)
+        manager.send_to_client(msg[len('{"request_id":"'):msg.index('"', len('{"request_id":"'))], worker_id, msg)
+
+
+async def client(manager, request_id: str, messages: int):
+    ticket = manager.put_in_queue(request_id, 'env')
+    bridge = await ticket.bridge
+    msg = '{"request_id":"' + request_id + '","stdout":"' + 'x' * 200 + '"}'
+    for _ in range(messages):
+        bridge.send_to_worker(msg)
+        await bridge.receive_from_worker()
+    bridge.close()
+    manager.remove_bridge(bridge)
+
+
+async def run_process(manager, index: int, clients: int, messages: int, start_at: float) -> float:
+    worker_tasks = []
+    for i in range(WORKERS_PER_PROCESS):
+        manager.register(f'p{index}w{i}', 'env', SLOTS)
+        worker_tasks.append(asyncio.create_task(echo_worker(manager, f'p{index}w{i}')))
+    await asyncio.sleep(max(0.0, start_at - time.time()))
+
+    start = time.time()
+    await asyncio.gather(*[client(manager, f'p{index}r{i}', messages) for i in range(clients)])
+    elapsed = time.time() - start
+
+    await asyncio.sleep(0.5) # let the other processes finish before unregistering our workers
+    for t in worker_tasks:
+        t.cancel()
+    return elapsed
+
+
+def process_main(path: str, index: int, clients: int, messages: int, start_at: float, results):
+    async def main():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return await run_process(broker.RemoteManager(path), index, clients, messages, start_at)
+    results.put(asyncio.run(main()))
+
+
+def measure(processes: int, clients: int, messages: int) -> float:
+    path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+    hub = subprocess.Popen([sys.executable, '-m', 'practicode_backend.broker', path],
+                           cwd=os.path.join(os.path.dirname(__file__), '..'), stdout=subprocess.DEVNULL)
+    try:
+        results = multiprocessing.Queue()
+        start_at = time.time() + 1.0
+        procs = [multiprocessing.Process(target=process_main, args=(path, i, clients, messages, start_at, results)) for i in range(processes)]
+        for p in procs:
+            p.start()
+        elapsed = max(results.get() for _ in procs)
+        for p in procs:
+            p.join()
+    finally:
+        hub.terminate()
+    return processes * clients * messages * 2 / elapsed
+
+
+def main():
+    max_processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    messages = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    async def in_process():
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed = await run_process(workers.WorkersManager(), 0, clients, messages, time.time())
+        return clients * messages * 2 / elapsed
+    print(f'in-process manager:   {asyncio.run(in_process()):10.0f} msgs/s')
+
+    for processes in range(1, max_processes + 1):
+        print(f'broker, {processes} process(es): {measure(processes, clients, messages):10.0f} msgs/s')
+
+
+if __name__ == '__main__':
+    main()
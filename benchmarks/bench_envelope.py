@@ -0,0 +1,51 @@
+"""
+Throughput of the routing work done per relayed worker->client message:
+the /bridge hop reads request_id, the /run hop reads request_id and finish.
+Compares full ujson decoding with envelope peeking on large stdout frames.
+
+Usage: python benchmarks/bench_envelope.py [frame_size_mb] [frames]
+"""
+import os
+import sys
+import time
+import ujson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from practicode_backend import envelope
+
+
+def route_parsed(msg: str):
+    request_id = json.loads(msg)['request_id'] # /bridge hop
+    msg_json = json.loads(msg) # /run hop
+    return request_id, msg_json['request_id'], msg_json.get('finish', None) == True
+
+
+def route_envelope(msg: str):
+    request_id = envelope.request_id_of(msg) # /bridge hop
+    return (request_id,) + envelope.peek(msg) # /run hop
+
+
+def measure(route, msg: str, frames: int) -> float:
+    start = time.perf_counter()
+    for _ in range(frames):
+        route(msg)
+    return time.perf_counter() - start
+
+
+def main():
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    line = 'Hello, "world"! \\ 0123456789 abcdefghijklmnopqrstuvwxyz\n'
+    stdout = (line * (int(size_mb * 1024 * 1024) // len(line) + 1))[:int(size_mb * 1024 * 1024)]
+    msg = json.dumps({'request_id': 'f9c1e1e2-7c55-4a40-a4a8-4b0cfa5b1c61', 'stdout': stdout})
+    print(f'{frames} frames of {len(msg) / 1024 / 1024:.2f} MB')
+
+    for name, route in (('ujson.loads', route_parsed), ('envelope', route_envelope)):
+        t = measure(route, msg, frames)
+        print(f'  {name:12} {frames / t:10.1f} frames/s {frames * len(msg) / t / 1024 / 1024:10.1f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Requests per second of GET /tasks/<task_id>, calling the Django view directly.
+
+Usage: python benchmarks/bench_get_task.py [requests]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.chdir(os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'practicode_backend.settings')
+
+import django
+django.setup()
+
+from django.test import RequestFactory
+from practicode_backend import views
+
+TASK_ID = 'cpp-condition-variable-1'
+
+
+def measure(requests: int, **headers) -> float:
+    factory = RequestFactory()
+    request = factory.get(f'/tasks/{TASK_ID}', **headers)
+    start = time.perf_counter()
+    for _ in range(requests):
+        resp = views.get_task(request, TASK_ID)
+    elapsed = time.perf_counter() - start
+    return requests / elapsed, resp
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rps, resp = measure(requests)
+    print(f'GET /tasks/{TASK_ID}: {rps:10.0f} req/s, status {resp.status_code}')
+    etag = resp.get('ETag')
+    if etag:
+        rps, resp = measure(requests, HTTP_IF_NONE_MATCH=etag)
+        print(f'  with If-None-Match: {rps:10.0f} req/s, status {resp.status_code}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Relay throughput of worker->client messages through the /bridge and /run handlers, in-process,
+with logging at info, at debug and at debug with sampling. Log lines go to /dev/null.
+
+Usage: python benchmarks/bench_logging.py [messages]
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import asgi_harness
+
+CASES = [
+    ('info', {'LOG_LEVEL': 'INFO'}),
+    ('debug', {'LOG_LEVEL': 'DEBUG'}),
+    ('debug, 1 of 100', {'LOG_LEVEL': 'DEBUG', 'LOG_RELAY_SAMPLE': '100'}),
+]
+
+
+async def relay(messages: int) -> float:
+    application = asgi_harness.load_application()
+    from practicode_backend import log
+
+    worker = asgi_harness.Connection(application, '/bridge', 'build_env=env')
+    await worker.accepted()
+    client = asgi_harness.Connection(application, '/run', 'task_id=t&target=run&build_env=env&request_id=r1')
+    await client.accepted()
+    await worker.receive() # new
+
+    line = '{"request_id": "r1", "stdout": "' + 'x' * 80 + '"}'
+    start = time.perf_counter()
+    for i in range(messages):
+        worker.send(line)
+        if i % 100 == 99:
+            await asyncio.sleep(0) # let the relay keep up, so the queues stay bounded
+    worker.send('{"request_id": "r1", "finish": true}')
+    received = 0
+    while True:
+        msg = await client.receive()
+        if msg is None or '"finish"' in msg:
+            break
+        received += 1
+    elapsed = time.perf_counter() - start
+    log.shutdown()
+    return received / elapsed
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        rate = asyncio.run(relay(int(sys.argv[2])))
+        sys.stderr.write(f'{rate}\n')
+        return
+
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    for name, env in CASES:
+        # the log level is read on import, so every case runs in its own process
+        child = subprocess.run([sys.executable, __file__, '--child', str(messages)], env={**os.environ, **env},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+        rate = float(child.stderr.strip().splitlines()[-1])
+        print(f'{name:>16}: {rate:10.0f} msgs/s')
+
+
+if __name__ == '__main__':
+    main()
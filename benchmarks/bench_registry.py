@@ -0,0 +1,62 @@
+"""
+Microbenchmark of WorkersManager lookups with many concurrent bridges:
+routing worker->client messages, making a bridge and worker disconnect cleanup.
+
+Usage: python benchmarks/bench_registry.py [bridges]
+"""
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from practicode_backend import workers
+
+
+def timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(i)
+    return (time.perf_counter() - start) / repeat
+
+
+async def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    manager = workers.WorkersManager()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # n busy workers with a bridge each, plus a single free one
+        for i in range(n + 1):
+            manager.register(f'w{i}', 'env')
+        bridges = []
+        for i in range(n):
+            bridges.append(manager.put_in_queue(f'r{i}', 'env').bridge.result())
+
+        routes = [(b.request_id, b.worker.worker_id) for b in bridges]
+        def route(i):
+            request_id, worker_id = routes[(i * 7919) % n]
+            manager.send_to_client(request_id, worker_id, 'msg')
+        t_route = timed(route, 2000)
+
+        def dispatch(i):
+            bridge = manager.put_in_queue('extra', 'env').bridge.result()
+            bridge.close()
+            manager.remove_bridge(bridge)
+        t_dispatch = timed(dispatch, 200)
+
+        def disconnect(i):
+            worker_id = routes[i][1]
+            manager.unregister(worker_id)
+        t_disconnect = timed(disconnect, 200)
+
+    print(f'{n} bridges:')
+    print(f'  send_to_client:      {t_route * 1e6:10.2f} us/msg')
+    print(f'  make + remove bridge:{t_dispatch * 1e6:10.2f} us')
+    print(f'  unregister worker:   {t_disconnect * 1e6:10.2f} us')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
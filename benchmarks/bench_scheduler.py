@@ -0,0 +1,101 @@
+"""
+The wait queue scheduler: cost of queueing and taking a request for growing queues, in which order
+one user spamming Run, a class of students and a teacher get a single worker, and the cost of giving
+a request to a free worker warm for its task while the head waits for its own warm worker.
+
+Usage: python benchmarks/bench_scheduler.py
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from practicode_backend import workers
+
+
+def cost(n: int) -> float:
+    # push + pop of one ticket into a queue of n tickets of n / 10 users
+    queue = workers.FairQueue()
+    for i in range(n):
+        queue.push(workers.Ticket(f'r{i}', 'env', f'u{i % (n // 10)}', workers.DEFAULT_PRIORITY, time.time() + random.uniform(60, 120)))
+    repeat = 20000
+    tickets = [workers.Ticket(f'x{i}', 'env', f'u{i % 100}', workers.DEFAULT_PRIORITY, time.time() + 120) for i in range(repeat)]
+    start = time.perf_counter()
+    for ticket in tickets:
+        queue.push(ticket)
+        queue.pop()
+    return (time.perf_counter() - start) / repeat
+
+
+def service_order() -> dict:
+    manager = workers.WorkersManager()
+    manager.register('busy', 'env') # every request waits for this worker
+    first = manager.put_in_queue('first', 'env').bridge.result()
+
+    tickets = []
+    deadline = time.time() + 120
+    for i in range(30):
+        tickets.append(manager.put_in_queue(f'spam{i}', 'env', 'spammer', workers.DEFAULT_PRIORITY, deadline))
+    for i in range(20):
+        tickets.append(manager.put_in_queue(f'student{i}', 'env', f'student{i}', workers.DEFAULT_PRIORITY, deadline))
+    tickets.append(manager.put_in_queue('teacher', 'env', 'teacher', workers.PRIORITIES['teacher'], deadline))
+    tickets.append(manager.put_in_queue('late', 'env', 'late', workers.DEFAULT_PRIORITY, time.time() + workers.URGENT_WINDOW / 2))
+
+    order = []
+    bridge = first
+    while True:
+        bridge.close()
+        manager.remove_bridge(bridge)
+        served = [t for t in tickets if t.bridge.done() and t.request_id not in order]
+        if not served:
+            break
+        order.append(served[0].request_id)
+        bridge = served[0].bridge.result()
+    return {
+        'late (near its deadline)': order.index('late') + 1,
+        'teacher': order.index('teacher') + 1,
+        'students, median': statistics.median(order.index(f'student{i}') + 1 for i in range(20)),
+        'students, last': max(order.index(f'student{i}') + 1 for i in range(20)),
+        'spammer, first': min(order.index(f'spam{i}') + 1 for i in range(30)),
+    }
+
+
+def warm_dispatch_cost(n: int) -> float:
+    # n free workers, each has recently run WORKER_TASKS tasks, the head waits for the one worker warm for its task
+    workers.AFFINITY_WAIT = 60 # the head keeps waiting throughout
+    manager = workers.WorkersManager()
+    manager.run_durations['env'] = 0.01
+    for i in range(n):
+        manager.register(f'w{i}', 'env')
+        for j in range(workers.WORKER_TASKS):
+            manager._warm_up(f'task{i}-{j}', manager.workers[f'w{i}'])
+    manager.register('hot', 'env')
+    manager._warm_up('hot', manager.workers['hot'])
+    manager.put_in_queue('hot0', 'env', 'teacher', affinity='hot') # takes the hot worker
+    manager.put_in_queue('hot1', 'env', 'teacher', affinity='hot') # waits for it at the head
+    repeat = 2000
+    start = time.perf_counter()
+    for k in range(repeat):
+        ticket = manager.put_in_queue(f'r{k}', 'env', f'u{k}', affinity=f'task{k % n}-{k % workers.WORKER_TASKS}')
+        bridge = ticket.bridge.result() # given to its warm worker right away
+        bridge.close()
+        manager.remove_bridge(bridge)
+    return (time.perf_counter() - start) / repeat
+
+
+async def main():
+    for n in (1000, 10000, 100000):
+        print(f'push + pop with {n:6} queued: {cost(n) * 1e6:6.2f} us')
+    for n in (10, 100, 1000):
+        print(f'warm dispatch with {n:4} free workers: {warm_dispatch_cost(n) * 1e6:6.2f} us')
+    print('served as number, of 52 requests for one worker (30 of them from one user):')
+    for who, place in service_order().items():
+        print(f'  {who:>26}: {place}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+"""
+Per-message overhead of the websocket wrapper: its own cost per send, receive and query parameter read over
+in-memory ASGI callables, and the relay throughput of worker->client messages through /bridge and /run with
+the in-process ASGI harness.
+
+Usage: python benchmarks/bench_websocket.py [messages]
+"""
+import asyncio
+import os
+import sys
+import time
+
+import asgi_harness
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+QUERY = 'task_id=cpp-condition-variable-1&target=run&build_env=cpp-generic&request_id=r1&user_id=u1&priority_token=t'
+LINE = '{"request_id": "r1", "stdout": "' + 'x' * 80 + '"}'
+
+
+async def wrapper_costs(messages: int) -> dict:
+    from practicode_backend.websocket import WebSocket
+
+    event = {'type': 'websocket.receive', 'text': LINE}
+
+    async def receive():
+        return event
+
+    async def send(message):
+        pass
+
+    scope = {'type': 'websocket', 'path': '/run', 'query_string': QUERY.encode(), 'headers': [(b'host', b'localhost')]}
+    ws = WebSocket(scope, receive, send)
+    ws._client_state = ws._app_state = 2 # connected, as after accept()
+
+    costs = {}
+    start = time.perf_counter()
+    for _ in range(messages):
+        await ws.send_text(LINE)
+    costs['send_text'] = (time.perf_counter() - start) / messages
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        await ws.receive_text()
+    costs['receive_text'] = (time.perf_counter() - start) / messages
+
+    queue_msg = {'queue': 12, 'estimated_wait': 3.5}
+    start = time.perf_counter()
+    for _ in range(messages):
+        await ws.send_json(queue_msg)
+    costs['send_json'] = (time.perf_counter() - start) / messages
+
+    # handle_run reads the query parameters of a new connection that many times
+    repeat = messages // 10
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fresh = WebSocket(scope, receive, send)
+        for param in ('task_id', 'target', 'build_env', 'request_id', 'resume', 'user_id', 'priority_token'):
+            fresh.query_params.get(param, '')
+    costs['query_params, 7 reads'] = (time.perf_counter() - start) / repeat
+    return costs
+
+
+async def relay(application, messages: int) -> float:
+    worker = asgi_harness.Connection(application, '/bridge', 'build_env=env')
+    await worker.accepted()
+    client = asgi_harness.Connection(application, '/run', 'task_id=t&target=run&build_env=env&request_id=r1')
+    await client.accepted()
+    await worker.receive() # new
+
+    start = time.perf_counter()
+    for i in range(messages):
+        worker.send(LINE)
+        if i % 100 == 99:
+            await asyncio.sleep(0) # let the relay keep up, so the queues stay bounded
+    worker.send('{"request_id": "r1", "finish": true}')
+    received = 0
+    while True:
+        msg = await client.receive()
+        if msg is None or '"finish"' in msg:
+            break
+        received += 1
+    return received / (time.perf_counter() - start)
+
+
+async def main(messages: int):
+    application = asgi_harness.load_application()
+    for name, cost in (await wrapper_costs(messages)).items():
+        print(f'{name:>22}: {cost * 1e9:8.0f} ns')
+    print(f'{"relay /bridge -> /run":>22}: {await relay(application, messages):8.0f} msgs/s')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
@@ -0,0 +1,87 @@
+"""
+Measures how WorkersManager delivers client->worker messages:
+  * idle CPU burnt by N connected workers that have nothing to receive
+  * send_to_worker -> receive_for_worker latency (p50/p99)
+
+Usage: python benchmarks/bench_worker_delivery.py [idle_workers] [idle_seconds] [messages]
+"""
+import asyncio
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from practicode_backend import workers
+
+
+async def worker_loop(manager: workers.WorkersManager, worker_id: str, on_msg=None):
+    while True:
+        msg = await manager.receive_for_worker(worker_id)
+        if on_msg:
+            on_msg(msg)
+
+
+def make_bridge(manager: workers.WorkersManager, request_id: str, build_env: str) -> workers.Bridge:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return manager.put_in_queue(request_id, build_env).bridge.result()
+
+
+async def idle_cpu(n_workers: int, seconds: float) -> float:
+    manager = workers.WorkersManager()
+    tasks = []
+    for i in range(n_workers):
+        manager.register(f'w{i}', 'env')
+        tasks.append(asyncio.create_task(worker_loop(manager, f'w{i}')))
+    await asyncio.sleep(0.1)
+
+    cpu_start = time.process_time()
+    await asyncio.sleep(seconds)
+    cpu = time.process_time() - cpu_start
+
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return cpu / seconds
+
+
+async def latency(n_messages: int):
+    manager = workers.WorkersManager()
+    manager.register('w0', 'env')
+    bridges = [make_bridge(manager, f'r{i}', 'env') for i in range(1)]
+
+    samples = []
+    def on_msg(msg):
+        samples.append(time.perf_counter() - float(msg))
+
+    task = asyncio.create_task(worker_loop(manager, 'w0', on_msg))
+    await asyncio.sleep(0.01)
+    for _ in range(n_messages):
+        await asyncio.sleep(random.uniform(0.001, 0.02)) # don't align with any polling period
+        random.choice(bridges).send_to_worker(repr(time.perf_counter())) # a message is a string, the timestamp is parsed back
+    await asyncio.sleep(0.1)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+async def main():
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+    n_messages = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+
+    cpu = await idle_cpu(n_workers, seconds)
+    print(f'idle CPU with {n_workers} workers: {cpu * 100:.1f}% of a core')
+
+    p50, p99 = await latency(n_messages)
+    print(f'send -> delivery latency over {n_messages} messages: p50 {p50 * 1000:.3f} ms, p99 {p99 * 1000:.3f} ms')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
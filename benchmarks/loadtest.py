@@ -0,0 +1,225 @@
+"""
+Load test of /run and /bridge against practicode_backend.asgi.application, in-process, with no network:
+simulated workers echo a configurable amount of output after a configurable latency, simulated students
+arrive over a ramp, send a submission and wait for `finish`. With --tasks and --cold-latency students work on
+several tasks and a worker takes longer to run a task it hasn't run lately, like a runner with a cold build cache.
+With --batch students ask for their output in batches, as arrays of messages.
+
+Reports throughput (output messages and the websocket frames they came in), queue wait (connect to the first ping) and end-to-end (connect to finish) latencies,
+event loop lag and peak memory. --save writes the results as JSON and --baseline compares with such a file.
+
+Usage: python benchmarks/loadtest.py [--clients 2000] [--workers 8] [--slots 4] [--ramp 2.0]
+                                     [--latency 0.05] [--messages 10] [--message-size 100]
+                                     [--target run] [--tasks 1] [--cold-latency 0] [--worker-cache 4] [--batch]
+                                     [--save results.json] [--baseline results.json]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import resource
+import statistics
+import time
+
+import asgi_harness
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+TASK_ID = 'cpp-condition-variable-1'
+BUILD_ENV = 'cpp-generic'
+LAG_INTERVAL = 0.01 # in seconds, how often the event loop lag is sampled
+
+
+class Stats:
+    def __init__(self):
+        self.queue_wait = []
+        self.end_to_end = []
+        self.messages = 0
+        self.frames = 0
+        self.failed = 0
+        self.loop_lag = []
+        self.warm_runs = 0
+        self.cold_runs = 0
+        self.task_of = {} # by request_id, simulated workers learn the task from it
+
+
+async def simulated_worker(application, args, stats: Stats, stop: asyncio.Event):
+    ws = asgi_harness.Connection(application, '/bridge', f'build_env={BUILD_ENV}&slots={args.slots}')
+    await ws.accepted()
+    output = 'x' * args.message_size
+    cache = collections.OrderedDict() # tasks the worker has built lately
+
+    async def run(request_id: str):
+        task_id = stats.task_of[request_id]
+        latency = args.latency * random.uniform(0.5, 1.5)
+        if task_id in cache:
+            cache.move_to_end(task_id)
+            stats.warm_runs += 1
+        else:
+            cache[task_id] = None
+            if len(cache) > args.worker_cache:
+                cache.popitem(last=False)
+            stats.cold_runs += 1
+            latency += args.cold_latency
+        await asyncio.sleep(latency)
+        for _ in range(args.messages):
+            ws.send(json.dumps({'request_id': request_id, 'stdout': output}))
+        ws.send(json.dumps({'request_id': request_id, 'finish': True}))
+
+    receive = asyncio.create_task(ws.receive())
+    while not stop.is_set():
+        done, _ = await asyncio.wait({receive}, timeout=0.1)
+        if not done:
+            continue
+        msg = receive.result()
+        if msg is None:
+            return
+        receive = asyncio.create_task(ws.receive())
+        if '"source"' in msg:
+            asyncio.create_task(run(json.loads(msg)['request_id']))
+    receive.cancel()
+    ws.close()
+
+
+async def simulated_student(application, args, i: int, stats: Stats):
+    request_id = f'load-{i}'
+    task_id = TASK_ID if args.tasks == 1 else f'{TASK_ID}-{random.randrange(args.tasks)}'
+    stats.task_of[request_id] = task_id
+    start = time.perf_counter()
+    query = f'task_id={task_id}&target={args.target}&build_env={BUILD_ENV}&request_id={request_id}'
+    ws = asgi_harness.Connection(application, '/run', query + ('&batch=1' if args.batch else ''))
+    await ws.accepted()
+    ws.send(json.dumps({'request_id': request_id, 'source': f'int main() {{ return {i % 7}; }}'}))
+
+    started = None
+    while True:
+        msg = await ws.receive()
+        if msg is None:
+            stats.failed += 1
+            return
+        if msg.startswith('{"ping"'):
+            if started is None:
+                started = time.perf_counter()
+            continue
+        if msg.startswith('{"queue"'):
+            continue
+        if request_id not in msg:
+            stats.failed += 1 # a backend error or someone else's output
+            return
+        stats.messages += len(json.loads(msg)) if msg.startswith('[') else 1
+        stats.frames += 1
+        if '"finish"' in msg:
+            break
+    end = time.perf_counter()
+    stats.queue_wait.append(started - start)
+    stats.end_to_end.append(end - start)
+    ws.close()
+
+
+async def measure_loop_lag(stats: Stats, stop: asyncio.Event):
+    while not stop.is_set():
+        before = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        stats.loop_lag.append(time.perf_counter() - before - LAG_INTERVAL)
+
+
+def percentiles(values: list) -> dict:
+    if len(values) < 2:
+        return {'p50': values[0] if values else 0.0, 'p95': values[0] if values else 0.0, 'p99': values[0] if values else 0.0}
+    q = statistics.quantiles(values, n=100, method='inclusive') # within the samples, 'exclusive' extrapolates past the max
+    return {'p50': q[49], 'p95': q[94], 'p99': q[98]}
+
+
+async def main(args) -> dict:
+    application = asgi_harness.load_application()
+    stats = Stats()
+    stop = asyncio.Event()
+
+    workers = [asyncio.create_task(simulated_worker(application, args, stats, stop)) for _ in range(args.workers)]
+    await asyncio.sleep(0.1) # let the workers register
+    lag = asyncio.create_task(measure_loop_lag(stats, stop))
+
+    start = time.perf_counter()
+    students = []
+    for i in range(args.clients):
+        arrival = start + args.ramp * i / args.clients
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        students.append(asyncio.create_task(simulated_student(application, args, i, stats)))
+    await asyncio.gather(*students)
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await asyncio.gather(lag, *workers)
+
+    return {
+        'clients': args.clients,
+        'finished': len(stats.end_to_end),
+        'failed': stats.failed,
+        'elapsed_s': elapsed,
+        'runs_per_s': len(stats.end_to_end) / elapsed,
+        'messages_per_s': stats.messages / elapsed,
+        'frames_per_s': stats.frames / elapsed,
+        'queue_wait_ms': {k: v * 1000 for k, v in percentiles(stats.queue_wait).items()},
+        'end_to_end_ms': {k: v * 1000 for k, v in percentiles(stats.end_to_end).items()},
+        'warm_run_share': stats.warm_runs / max(stats.warm_runs + stats.cold_runs, 1),
+        'loop_lag_ms': {**{k: v * 1000 for k, v in percentiles(stats.loop_lag).items()}, 'max': max(stats.loop_lag, default=0.0) * 1000},
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, # kilobytes on linux
+    }
+
+
+def flatten(results: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def report(results: dict, baseline: dict = None):
+    flat = flatten(results)
+    flat_baseline = flatten(baseline) if baseline else {}
+    for key, value in flat.items():
+        line = f'{key:>22}: {value:12.2f}'
+        if key in flat_baseline:
+            before = flat_baseline[key]
+            change = (value - before) / before * 100 if before else 0.0
+            line += f'   baseline {before:12.2f} ({change:+.1f}%)'
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='In-process load test of /run and /bridge')
+    parser.add_argument('--clients', type=int, default=2000, help='simulated students')
+    parser.add_argument('--workers', type=int, default=8, help='simulated workers')
+    parser.add_argument('--slots', type=int, default=4, help='requests a worker runs at once')
+    parser.add_argument('--ramp', type=float, default=2.0, help='seconds over which students arrive')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean seconds a worker takes to run a submission')
+    parser.add_argument('--messages', type=int, default=10, help='output messages of a run')
+    parser.add_argument('--message-size', type=int, default=100, help='characters of output in a message')
+    parser.add_argument('--target', default='run', help='target of the runs, e.g. run or tests')
+    parser.add_argument('--tasks', type=int, default=1, help='tasks students pick from at random')
+    parser.add_argument('--cold-latency', type=float, default=0.0, help='seconds added to a run of a task the worker hasn\'t run lately')
+    parser.add_argument('--worker-cache', type=int, default=4, help='tasks a worker keeps built')
+    parser.add_argument('--batch', action='store_true', help='students ask for their output in batches')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results saved by --save')
+    args = parser.parse_args()
+    # the application is loaded from the repo's directory
+    args.save = args.save and os.path.abspath(args.save)
+    args.baseline = args.baseline and os.path.abspath(args.baseline)
+
+    results = asyncio.run(main(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 from django.urls import resolve
 from practicode_backend.websocket import WebSocket
@@ -17,6 +18,18 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'practicode_backend.settings')
 
 django_http_application = get_asgi_application()
 
+# these use models, so they are imported once django is set up
+from practicode_backend import broker, log, task_catalog, workers
+
+log.setup()
+
+if settings.BROKER_SOCKET:
+    # share workers and queues with the other server processes
+    workers.instance = broker.RemoteManager(settings.BROKER_SOCKET)
+
+if settings.PRELOAD_TASKS:
+    task_catalog.catalog().preload_at_startup()
+
 async def application(scope, receive, send):
     if scope['type'] == 'http':
         await django_http_application(scope, receive, send)
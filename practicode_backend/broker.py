@@ -0,0 +1,543 @@
+# Broker that lets several server processes on one host share the workers registry, the wait queues and routing.
+#
+# The in-process WorkersManager stays the default. With BROKER_SOCKET set, one hub process
+# (python -m practicode_backend.broker <socket path>) owns the only WorkersManager, and every
+# server process talks to it through a RemoteManager, which has the same interface as WorkersManager
+# for handle_run and handle_bridge. A /run client and a worker can then land on any process.
+#
+# Frames over the unix socket: two big-endian uint32 lengths, a small JSON list [op, args...]
+# and the relayed message itself as a raw body, which is never decoded by the broker.
+#
+# The bridges, with their bounded queues, are in the hub. So that they fill up, and a worker is paused or its output
+# truncated, when a client or a worker socket in some process doesn't keep up, the hub relays the output of a run and
+# the messages to a worker only while less than the bridge limits of them are in flight to the process (a Window),
+# the process reports what it has consumed (a Credit). The other way, a process stops reading a client while the hub
+# reports that the bridge to its worker is full.
+import asyncio
+import collections
+import os
+import struct
+import sys
+import ujson as json
+from typing import Deque, Dict, Optional, Set, Tuple
+from . import log
+from . import metrics
+from . import workers
+
+logger = log.get('broker')
+
+HEADER = struct.Struct('!II')
+REPORT_CONSUMED_AT = 0.25 # a process reports what it has consumed once it's that share of the window
+CONNECT_ATTEMPTS = 50 # at startup, before the hub is considered down
+CONNECT_RETRY_DELAY = 0.1 # in seconds
+RECONNECT_MAX_DELAY = 5.0 # in seconds, the retry delay doubles up to that while the hub is down
+
+
+def pack(head: list, body: str = '') -> bytes:
+    head_bytes = json.dumps(head).encode()
+    body_bytes = body.encode()
+    return HEADER.pack(len(head_bytes), len(body_bytes)) + head_bytes + body_bytes
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[list, str]:
+    head_len, body_len = HEADER.unpack(await reader.readexactly(HEADER.size))
+    data = await reader.readexactly(head_len + body_len)
+    return json.loads(data[:head_len]), data[head_len:].decode()
+
+
+class Outbox:
+    # writes frames to a stream from a single task, so senders never block
+    def __init__(self):
+        self.frames: Deque[bytes] = collections.deque()
+        self.has_frames = asyncio.Event()
+
+    def put(self, frame: bytes):
+        self.frames.append(frame)
+        self.has_frames.set()
+
+    async def write_loop(self, writer: asyncio.StreamWriter):
+        while True:
+            while len(self.frames) > 0:
+                writer.write(self.frames.popleft())
+            await writer.drain()
+            if len(self.frames) == 0:
+                self.has_frames.clear()
+                await self.has_frames.wait()
+
+
+class Window:
+    # messages the hub has relayed to a process and the process hasn't consumed yet, the hub waits for room
+    def __init__(self, max_messages: int = workers.MAX_QUEUED_MESSAGES, max_bytes: int = workers.MAX_QUEUED_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.msgs = 0
+        self.bytes = 0
+        self.room = asyncio.Event()
+        self.room.set()
+
+    def sent(self, msg: str):
+        self.msgs += 1
+        self.bytes += len(msg)
+        if self.msgs >= self.max_messages or self.bytes >= self.max_bytes:
+            self.room.clear()
+
+    def consumed(self, msgs: int, nbytes: int):
+        self.msgs -= msgs
+        self.bytes -= nbytes
+        if self.msgs < self.max_messages and self.bytes < self.max_bytes:
+            self.room.set()
+
+
+class Credit:
+    # messages a process has consumed since it last reported them to the hub's Window
+    def __init__(self, max_messages: int = workers.MAX_QUEUED_MESSAGES, max_bytes: int = workers.MAX_QUEUED_BYTES):
+        self.report_messages = max_messages * REPORT_CONSUMED_AT
+        self.report_bytes = max_bytes * REPORT_CONSUMED_AT
+        self.msgs = 0
+        self.bytes = 0
+
+    def consumed(self, msg: str) -> Optional[Tuple[int, int]]:
+        # (messages, bytes) to report, if it's time to
+        self.msgs += 1
+        self.bytes += len(msg)
+        if self.msgs < self.report_messages and self.bytes < self.report_bytes:
+            return None
+        report = self.msgs, self.bytes
+        self.msgs = self.bytes = 0
+        return report
+
+
+class HubRun:
+    # a /run request of some server process, as the hub sees it
+    def __init__(self, ticket: workers.Ticket):
+        self.ticket = ticket
+        self.bridge: Optional[workers.Bridge] = None
+        self.task: Optional[asyncio.Task] = None
+        self.window = Window() # of its output
+        self.room_task: Optional[asyncio.Task] = None # while the bridge to the worker is full
+
+
+class HubConnection:
+    # hub side of a connection with one server process
+    def __init__(self, manager: workers.WorkersManager):
+        self.manager = manager
+        self.outbox = Outbox()
+        self.worker_tasks: Dict[str, asyncio.Task] = {}
+        self.worker_windows: Dict[str, Window] = {}
+        self.runs: Dict[str, HubRun] = {}
+
+    def send(self, head: list, body: str = ''):
+        self.outbox.put(pack(head, body))
+
+    def handle_frame(self, head: list, body: str):
+        op = head[0]
+        if op == 'to_client':
+            try:
+                self.manager.send_to_client(head[1], head[2], body)
+            except Exception as e:
+                logger.warning('%s', e)
+        elif op == 'to_worker':
+            run = self.runs.get(head[1])
+            if run is not None and run.bridge is not None:
+                run.bridge.send_to_worker(body)
+                if not run.bridge.room_to_worker.is_set() and run.room_task is None:
+                    run.room_task = asyncio.create_task(self.room_loop(head[1], run))
+        elif op == 'consumed':
+            run = self.runs.get(head[1])
+            if run is not None:
+                run.window.consumed(head[2], head[3])
+        elif op == 'worker_consumed':
+            window = self.worker_windows.get(head[1])
+            if window is not None:
+                window.consumed(head[2], head[3])
+        elif op == 'register':
+            self.register(head[1], head[2], head[3], head[4])
+        elif op == 'unregister':
+            self.unregister(head[1])
+        elif op == 'enqueue':
+            self.enqueue(head[1], head[2], head[3], head[4], head[5], head[6])
+        elif op == 'release':
+            self.release(head[1])
+        elif op == 'cancel':
+            self.release(head[1], cancel=True)
+        else:
+            logger.error('unknown op %s', op)
+
+    def register(self, worker_id: str, build_env: str, slots: int, flow_control: bool):
+        self.manager.register(worker_id, build_env, slots, flow_control)
+        self.worker_windows[worker_id] = Window()
+        self.worker_tasks[worker_id] = asyncio.create_task(self.worker_loop(worker_id, self.worker_windows[worker_id]))
+
+    def unregister(self, worker_id: str):
+        task = self.worker_tasks.pop(worker_id, None)
+        if task is not None:
+            task.cancel()
+        self.worker_windows.pop(worker_id, None)
+        self.manager.unregister(worker_id)
+
+    async def worker_loop(self, worker_id: str, window: Window):
+        # the same as handle_bridge.receive_from_client_loop, but the worker's socket is in another process,
+        # messages stay in the bridges while the process hasn't sent the previous ones to the worker
+        while True:
+            if not window.room.is_set():
+                await window.room.wait()
+            msg = await self.manager.receive_for_worker(worker_id)
+            window.sent(msg)
+            self.send(['to_worker', worker_id], msg)
+
+    async def room_loop(self, request_id: str, run: HubRun):
+        # the process stops reading the client until the bridge to the worker has room again
+        self.send(['room_to_worker', request_id, False])
+        await run.bridge.room_to_worker.wait()
+        run.room_task = None
+        self.send(['room_to_worker', request_id, True])
+
+    def enqueue(self, request_id: str, build_env: str, user: str, priority: int, deadline: Optional[float], affinity: Optional[str]):
+        run = HubRun(self.manager.put_in_queue(request_id, build_env, user, priority, deadline, affinity))
+        run.task = asyncio.create_task(self.run_loop(request_id, run))
+        self.runs[request_id] = run
+
+    async def run_loop(self, request_id: str, run: HubRun):
+        ticket = run.ticket
+        while not ticket.bridge.done():
+            # the position is pushed to the process when it changes, as the manager publishes it
+            self.send(['queue', request_id, self.manager.queue_number(ticket), ticket.head_since, self.manager.estimated_wait(ticket),
+                       self.manager.build_env_label(ticket.build_env)])
+            await workers.wait_for_ticket(ticket, None)
+
+        try:
+            run.bridge = ticket.bridge.result()
+        except workers.RejectedError as e:
+            self.send(['rejected', request_id, e.retry_after])
+            return
+        self.send(['bridged', request_id, run.bridge.worker_id])
+        try:
+            while True:
+                # the output stays in the bridge while the process hasn't relayed enough of it to the client
+                if not run.window.room.is_set():
+                    await run.window.room.wait()
+                msg = await run.bridge.receive_from_worker()
+                run.window.sent(msg)
+                self.send(['to_run', request_id], msg)
+        except workers.DisconnectError:
+            self.send(['worker_disconnected', request_id])
+
+    def release(self, request_id: str, cancel: bool = False):
+        # the request has finished or given up waiting, or its client is gone before it has finished
+        run = self.runs.pop(request_id, None)
+        if run is None:
+            return
+        run.task.cancel()
+        if run.room_task is not None:
+            run.room_task.cancel()
+        bridge = run.bridge or self.manager.leave_queue(run.ticket)
+        if bridge and cancel:
+            self.manager.cancel(bridge)
+        elif bridge:
+            bridge.close()
+            self.manager.remove_bridge(bridge)
+
+    def close(self):
+        for request_id in list(self.runs):
+            self.release(request_id, cancel=True) # its clients are gone
+        for worker_id in list(self.worker_tasks):
+            self.unregister(worker_id)
+
+
+class BrokerServer:
+    def __init__(self, manager: workers.WorkersManager):
+        self.manager = manager
+
+    async def serve(self, path: str, metrics_port: int = 0):
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle, path=path)
+        logger.info('listening on %s', path)
+        if metrics_port:
+            # the manager lives here, so do its metrics, server processes only have their own
+            await asyncio.start_server(self.serve_metrics, '127.0.0.1', metrics_port)
+            logger.info('serving metrics on port %s', metrics_port)
+        async with server:
+            await server.serve_forever()
+
+    async def serve_metrics(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # any request gets the metrics, it's only for a scraper on the same host
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = metrics.render().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        conn = HubConnection(self.manager)
+        write_task = asyncio.create_task(conn.outbox.write_loop(writer))
+        logger.info('a server process has connected')
+        try:
+            while True:
+                head, body = await read_frame(reader)
+                conn.handle_frame(head, body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info('a server process has disconnected')
+        finally:
+            conn.close()
+            write_task.cancel()
+            writer.close()
+
+
+class RemoteTicket:
+    # the same as workers.Ticket, position and head_since are reported by the hub
+    def __init__(self, request_id: str, build_env: str, deadline: Optional[float] = None):
+        self.request_id = request_id
+        self.build_env = build_env
+        self.deadline = deadline
+        self.bridge: asyncio.Future = asyncio.get_event_loop().create_future()
+        self.head_since: Optional[float] = None
+        self.position: Optional[int] = None
+        self.estimated_wait: Optional[float] = None
+        self.news: Optional[asyncio.Future] = None
+
+    def notify(self):
+        if self.news is not None and not self.news.done():
+            self.news.set_result(None)
+
+
+class RemoteBridge:
+    # the same interface as workers.Bridge, the actual bridge lives in the hub
+    def __init__(self, manager: 'RemoteManager', request_id: str, worker_id: str):
+        self.manager = manager
+        self.request_id = request_id
+        self.worker_id = worker_id
+        self.msgs_to_client = asyncio.Queue() # bounded by the hub's Window of the run
+        self.credit = Credit()
+        self.room_to_worker = asyncio.Event() # cleared while the hub reports that the bridge to the worker is full
+        self.room_to_worker.set()
+        self.disconnected = False
+
+    async def receive_from_worker(self):
+        msg = await self.msgs_to_client.get()
+        if isinstance(msg, Exception):
+            raise msg
+        report = self.credit.consumed(msg)
+        if report is not None:
+            self.manager.send(['consumed', self.request_id, *report])
+        return msg
+
+    def send_to_worker(self, msg):
+        if type(msg) == dict:
+            msg = json.dumps(msg)
+        self.manager.send(['to_worker', self.request_id], msg)
+
+    def attach_trace(self, trace):
+        # the bridge's queues are in the hub, a remote run is traced by its stages only
+        pass
+
+    async def wait_for_room_to_worker(self):
+        await self.room_to_worker.wait()
+
+    def send_to_client(self, msg: str):
+        self.msgs_to_client.put_nowait(msg)
+
+    def close(self):
+        self.manager.send(['release', self.request_id])
+
+    def disconnect(self):
+        self.msgs_to_client.put_nowait(workers.DisconnectError())
+        self.disconnected = True
+        self.room_to_worker.set() # nothing waits for the hub anymore
+
+    def interrupt(self, error: Exception):
+        self.msgs_to_client.put_nowait(error)
+
+
+class RemoteManager:
+    # the same interface as workers.WorkersManager for handle_run and handle_bridge, backed by the hub
+    def __init__(self, path: str):
+        self.path = path
+        self.outbox: Optional[Outbox] = None # created on first use, when the event loop is running
+        self.down = False # the connection with the hub is lost, until it's back runs fail right away
+        self.workers: Dict[str, tuple] = {} # registrations of this process' workers, to repeat them after a reconnect
+        self.worker_inboxes: Dict[str, asyncio.Queue] = {}
+        self.worker_credits: Dict[str, Credit] = {}
+        self.tickets: Dict[str, RemoteTicket] = {}
+        self.bridges: Dict[str, RemoteBridge] = {}
+        self.served_build_envs: Set[str] = set() # the ones the hub has workers for, as it has reported
+
+    def send(self, head: list, body: str = ''):
+        if self.outbox is None:
+            self.outbox = Outbox()
+            asyncio.create_task(self.connection_loop())
+        if not self.down: # the hub has forgotten everything of a lost connection, there's nothing to tell it
+            self.outbox.put(pack(head, body))
+
+    async def connection_loop(self):
+        attempt = 0
+        delay = CONNECT_RETRY_DELAY
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionError):
+                attempt += 1
+                if attempt == CONNECT_ATTEMPTS:
+                    logger.error('couldn\'t connect to %s, will keep trying', self.path)
+                    self.go_down()
+                if self.down:
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                await asyncio.sleep(delay) # the hub could be still starting or restarting
+                continue
+
+            if self.down:
+                logger.info('reconnected to %s', self.path)
+                self.down = False
+                for worker_id, registration in self.workers.items():
+                    self.worker_credits[worker_id] = Credit() # the hub's Window is new
+                    self.send(['register', worker_id, *registration])
+            attempt = 0
+            delay = CONNECT_RETRY_DELAY
+
+            write_task = asyncio.create_task(self.outbox.write_loop(writer))
+            try:
+                while True:
+                    head, body = await read_frame(reader)
+                    self.handle_frame(head, body)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.error('lost connection to %s', self.path)
+            finally:
+                write_task.cancel()
+                writer.close()
+            self.go_down()
+
+    def go_down(self):
+        self.down = True
+        self.outbox.frames.clear()
+        self.fail_all()
+
+    def fail_all(self):
+        for ticket in self.tickets.values():
+            if not ticket.bridge.done():
+                ticket.bridge.set_exception(workers.DisconnectError())
+                ticket.notify()
+        self.tickets.clear()
+        for bridge in self.bridges.values():
+            bridge.disconnect()
+        self.bridges.clear()
+
+    def handle_frame(self, head: list, body: str):
+        op = head[0]
+        if op == 'to_worker':
+            inbox = self.worker_inboxes.get(head[1])
+            if inbox is not None:
+                inbox.put_nowait(body)
+        elif op == 'to_run':
+            bridge = self.bridges.get(head[1])
+            if bridge is not None:
+                bridge.send_to_client(body)
+        elif op == 'room_to_worker':
+            bridge = self.bridges.get(head[1])
+            if bridge is not None:
+                if head[2]:
+                    bridge.room_to_worker.set()
+                else:
+                    bridge.room_to_worker.clear()
+        elif op == 'queue':
+            ticket = self.tickets.get(head[1])
+            if ticket is not None:
+                ticket.position, ticket.head_since, ticket.estimated_wait = head[2], head[3], head[4]
+                if head[5] == ticket.build_env:
+                    self.served_build_envs.add(ticket.build_env)
+                ticket.notify()
+        elif op == 'rejected':
+            ticket = self.tickets.pop(head[1], None)
+            if ticket is not None and not ticket.bridge.done():
+                ticket.bridge.set_exception(workers.RejectedError(head[2]))
+                ticket.notify()
+        elif op == 'bridged':
+            ticket = self.tickets.pop(head[1], None)
+            if ticket is not None and not ticket.bridge.done():
+                bridge = RemoteBridge(self, head[1], head[2])
+                self.bridges[head[1]] = bridge
+                self.served_build_envs.add(ticket.build_env)
+                ticket.bridge.set_result(bridge)
+                ticket.notify()
+        elif op == 'worker_disconnected':
+            bridge = self.bridges.get(head[1])
+            if bridge is not None:
+                bridge.disconnect()
+        else:
+            logger.error('unknown op %s', op)
+
+    def register(self, worker_id: str, build_env: str, slots: int = 1, flow_control: bool = False):
+        self.worker_inboxes[worker_id] = asyncio.Queue() # bounded by the hub's Window of the worker
+        self.worker_credits[worker_id] = Credit()
+        self.workers[worker_id] = (build_env, slots, flow_control)
+        self.send(['register', worker_id, build_env, slots, flow_control])
+
+    def unregister(self, worker_id: str):
+        self.worker_inboxes.pop(worker_id, None)
+        self.worker_credits.pop(worker_id, None)
+        self.workers.pop(worker_id, None)
+        self.send(['unregister', worker_id])
+
+    async def receive_for_worker(self, worker_id: str) -> str:
+        msg = await self.worker_inboxes[worker_id].get()
+        credit = self.worker_credits.get(worker_id)
+        report = credit.consumed(msg) if credit is not None else None
+        if report is not None:
+            self.send(['worker_consumed', worker_id, *report])
+        return msg
+
+    def send_to_client(self, request_id: str, worker_id: str, msg: str):
+        self.send(['to_client', request_id, worker_id], msg)
+
+    def put_in_queue(self, request_id: str, build_env: str, user: str = '', priority: int = workers.DEFAULT_PRIORITY,
+                     deadline: Optional[float] = None, affinity: Optional[str] = None) -> RemoteTicket:
+        ticket = RemoteTicket(request_id, build_env, deadline)
+        if self.down:
+            # a run fails right away instead of waiting for its deadline in a queue nobody serves
+            ticket.bridge.set_exception(workers.DisconnectError())
+            return ticket
+        self.tickets[request_id] = ticket
+        self.send(['enqueue', request_id, build_env, user, priority, deadline, affinity])
+        return ticket
+
+    def leave_queue(self, ticket: RemoteTicket) -> Optional[RemoteBridge]:
+        if ticket.bridge.done() and not ticket.bridge.cancelled() and ticket.bridge.exception() is None:
+            return ticket.bridge.result()
+        self.tickets.pop(ticket.request_id, None)
+        ticket.bridge.cancel()
+        self.send(['release', ticket.request_id])
+        return None
+
+    def remove_bridge(self, bridge: RemoteBridge):
+        self.bridges.pop(bridge.request_id, None)
+
+    def cancel(self, bridge: RemoteBridge):
+        self.send(['cancel', bridge.request_id])
+        self.remove_bridge(bridge)
+
+    def build_env_label(self, build_env: str) -> str:
+        return build_env if build_env in self.served_build_envs else workers.OTHER_BUILD_ENV
+
+    def queue_number(self, ticket: RemoteTicket) -> Optional[int]:
+        return ticket.position
+
+    def estimated_wait(self, ticket: RemoteTicket) -> Optional[float]:
+        return ticket.estimated_wait
+
+    def collect_metrics(self):
+        # workers, queues and bridges are in the hub, it serves their metrics on BROKER_METRICS_PORT
+        pass
+
+    def bridges_stats(self) -> list:
+        # the bridges' queues are in the hub
+        return []
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else os.getenv('BROKER_SOCKET', '/tmp/practicode-broker.sock')
+    log.setup()
+    asyncio.run(BrokerServer(workers.manager()).serve(path, int(os.getenv('BROKER_METRICS_PORT', '0'))))
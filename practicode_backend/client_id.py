@@ -0,0 +1,40 @@
+# Who a /run client is, for taking turns in the wait queue.
+#
+# GET /runner and GET /tasks/<task_id> give a browser a random id in a signed cookie, and its /run connections send it back.
+# A client can't make ids up, so it can't jump the queue with a new identity per request the way it could with ?user_id=,
+# and students behind one NAT or proxy address still take turns with each other. A client without the cookie,
+# e.g. a frontend on another site that doesn't send credentials, is known by its address.
+from django.core import signing
+from django.http import parse_cookie
+import uuid
+from typing import Optional
+
+COOKIE = 'practicode_client'
+SALT = 'practicode.client_id'
+MAX_AGE = 365 * 24 * 3600 # in seconds
+
+
+def _unsign(value: Optional[str]) -> Optional[str]:
+    if not value:
+        return None
+    try:
+        # the same signer as HttpResponse.set_signed_cookie() uses
+        return signing.get_cookie_signer(salt=COOKIE + SALT).unsign(value, max_age=MAX_AGE)
+    except signing.BadSignature:
+        return None
+
+
+def issue(request, response):
+    # a client keeps its id as long as it keeps the cookie
+    if _unsign(request.COOKIES.get(COOKIE)) is None:
+        response.set_signed_cookie(COOKIE, uuid.uuid4().hex, salt=SALT, max_age=MAX_AGE, httponly=True, samesite='Lax',
+                                   secure=request.is_secure())
+
+
+def of_connection(ws) -> str:
+    # the id of a /run connection, or its address (behind a proxy, run uvicorn with --proxy-headers)
+    cookie = ws.headers.get('cookie')
+    client_id = _unsign(parse_cookie(cookie).get(COOKIE)) if cookie else None
+    if client_id is not None:
+        return 'id:' + client_id
+    return 'addr:' + ws.scope['client'][0] if ws.scope.get('client') else ''
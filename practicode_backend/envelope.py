@@ -0,0 +1,68 @@
+# Routing envelope of the messages relayed between /run clients and /bridge workers.
+#
+# Every message is a JSON object with a "request_id" key. The relay only needs the request id and
+# the "finish" flag, so instead of decoding a whole (possibly megabytes long) message it peeks at them:
+#   * a message that starts with {"request_id":"<id>", is routed by that prefix,
+#   * "finish" is found by a substring search: quotes inside JSON strings are always escaped,
+#     so an unescaped "finish" can only be a key (or a whole string value, then we parse).
+# Messages that don't follow the layout are parsed as before, so the framing stays plain JSON.
+# The backend puts "request_id" first in every message it creates itself.
+# Messages from clients are small and not trusted, they are parsed whole, see client_request_id().
+import ujson as json
+from typing import Optional, Tuple
+
+REQUEST_ID_PREFIXES = ('{"request_id":"', '{"request_id": "')
+
+
+def request_id_of(msg: str) -> str:
+    for prefix in REQUEST_ID_PREFIXES:
+        if msg.startswith(prefix):
+            end = msg.find('"', len(prefix))
+            request_id = msg[len(prefix):end]
+            if end != -1 and '\\' not in request_id:
+                return request_id
+            break
+    return json.loads(msg)['request_id']
+
+
+def client_request_id(msg: str) -> Optional[str]:
+    # a client could put a second "request_id" after the first one, and parsers keep the last one,
+    # so the id the worker sees is only known from the whole message; None if the message isn't an object with an id
+    try:
+        msg_json = json.loads(msg)
+    except ValueError:
+        return None
+    if not isinstance(msg_json, dict):
+        return None
+    request_id = msg_json.get('request_id')
+    return request_id if isinstance(request_id, str) else None
+
+
+def strip_request_id(msg: str) -> str:
+    # the message without its request id, in the form with_request_id() takes: ',<other keys>}' or '}'
+    for prefix in REQUEST_ID_PREFIXES:
+        if msg.startswith(prefix):
+            end = msg.find('"', len(prefix))
+            if end != -1 and '\\' not in msg[len(prefix):end]:
+                return msg[end+1:]
+            break
+    msg_json = json.loads(msg)
+    msg_json.pop('request_id', None)
+    rest = json.dumps(msg_json)
+    return '}' if rest == '{}' else ',' + rest[1:]
+
+
+def with_request_id(rest: str, request_id: str) -> str:
+    return '{"request_id":' + json.dumps(request_id) + rest
+
+
+def is_finish(msg: str) -> bool:
+    if '"finish"' not in msg:
+        return False
+    if '"finish":true' in msg or '"finish": true' in msg:
+        return True
+    return json.loads(msg).get('finish', None) == True
+
+
+def peek(msg: str) -> Tuple[str, bool]:
+    return request_id_of(msg), is_finish(msg)
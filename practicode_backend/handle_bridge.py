@@ -1,17 +1,99 @@
 from . import workers
 from . import websocket
+from . import envelope
+from . import log
+from . import metrics
 import uuid
-import ujson as json
 import asyncio
+import os
+import time
+from typing import Dict, Optional, Set
 
-async def receive_from_client_loop(worker_id: str, ws: websocket.WebSocket):
+logger = log.get('bridge')
+
+WORKER_EVICTIONS = metrics.counter('practicode_worker_evictions_total', 'Workers disconnected by the backend because they stalled', ('reason',))
+
+# in seconds, a worker that has asked for heartbeats is pinged that often and must answer with {"command": "pong"}
+HEARTBEAT_INTERVAL = float(os.getenv('WORKER_HEARTBEAT_INTERVAL', '5'))
+# in seconds, a worker with heartbeats that hasn't sent anything for that long is evicted
+STALL_TIMEOUT = float(os.getenv('WORKER_STALL_TIMEOUT', '20'))
+# in seconds, any worker that hasn't sent anything for that long since it was sent a message is evicted, 0 turns it off
+PROGRESS_TIMEOUT = float(os.getenv('WORKER_PROGRESS_TIMEOUT', '120'))
+PING = '{"command":"ping"}'
+PONGS = ('{"command":"pong"}', '{"command": "pong"}')
+# flow control commands the backend sends (see workers.Bridge), the worker doesn't answer them
+PAUSE_SUFFIX = '"command":"pause"}'
+RESUME_SUFFIX = '"command":"resume"}'
+CANCEL_SUFFIX = '"command":"cancel"}'
+
+
+class Liveness:
+    # when a worker was last heard from, and since when it has owed an answer to a message, by request:
+    # a paused request owes nothing, its output is held back until the client catches up
+    def __init__(self, heartbeats: bool):
+        self.heartbeats = heartbeats
+        self.heard_at = time.monotonic()
+        self.owed_since: Dict[str, float] = {}
+        self.paused: Set[str] = set()
+        self.evicted = False
+
+    def heard(self):
+        self.heard_at = time.monotonic()
+        self.owed_since.clear()
+
+    def sent(self, request_id: str, msg: str):
+        if msg.endswith(PAUSE_SUFFIX):
+            self.paused.add(request_id)
+            self.owed_since.pop(request_id, None)
+        elif msg.endswith(RESUME_SUFFIX):
+            self.paused.discard(request_id) # the output comes only if the program has more of it
+        elif msg.endswith(CANCEL_SUFFIX):
+            self.paused.discard(request_id)
+            self.owed_since.setdefault(request_id, time.monotonic()) # the worker confirms a cancel
+        elif request_id not in self.paused:
+            self.owed_since.setdefault(request_id, time.monotonic())
+
+    def stall(self) -> Optional[str]:
+        # why the worker is considered stalled, if it is
+        now = time.monotonic()
+        if self.heartbeats and now - self.heard_at > STALL_TIMEOUT:
+            return 'heartbeat'
+        if PROGRESS_TIMEOUT > 0 and self.owed_since and now - min(self.owed_since.values()) > PROGRESS_TIMEOUT:
+            return 'progress'
+        return None
+
+
+async def watch_loop(worker_id: str, ws: websocket.WebSocket, liveness: Liveness):
+    # pings the worker and evicts it once it stalls, its runs fail over to other workers
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        reason = liveness.stall()
+        if reason is not None:
+            logger.warning('worker has stalled, evicting it', extra=log.fields(worker_id=worker_id, reason=reason))
+            WORKER_EVICTIONS.labels(reason).inc()
+            liveness.evicted = True
+            workers.manager().unregister(worker_id)
+            try:
+                await ws.close()
+            except Exception:
+                pass # the connection is gone already
+            return
+        if liveness.heartbeats:
+            try:
+                await ws.send_text(PING)
+            except Exception:
+                return # the connection is closing, handle() cleans up
+
+
+async def receive_from_client_loop(worker_id: str, ws: websocket.WebSocket, liveness: Liveness):
     try:
         while True:
             msg: str = await workers.manager().receive_for_worker(worker_id)
-            msg_json = json.loads(msg) # TODO: delete or do only that in DEBUG
-            request_id = msg_json["request_id"]
+            request_id = envelope.request_id_of(msg)
+            liveness.sent(request_id, msg)
 
-            print(f'/bridge: sending message from request {request_id} to worker {worker_id}: {msg[:48]}')
+            if log.relay_debug and log.sampled():
+                logger.debug('sending message to worker', extra=log.fields(request_id=request_id, worker_id=worker_id, msg=msg))
             await ws.send_text(msg)
 
     except asyncio.CancelledError:
@@ -24,32 +106,57 @@ async def handle(ws: websocket.WebSocket):
     worker_id = str(uuid.uuid4())
     build_env = ws.query_params.get('build_env', '')
     if build_env == '':
-        print(f'/bridge: worker didn\'t set build_env in their request')
+        logger.warning('worker didn\'t set build_env in their request')
+        return
+
+    # how many requests the worker can run at once
+    slots = ws.query_params.get('slots', '1')
+    if not slots.isdecimal() or int(slots) < 1:
+        logger.warning('worker set invalid slots', extra=log.fields(slots=slots))
         return
+    slots = int(slots)
+    # whether the worker can pause a request's output when the client doesn't keep up
+    flow_control = ws.query_params.get('flow_control', '0') == '1'
+    # whether the worker answers pings, so it can be told from a hung one
+    heartbeats = ws.query_params.get('heartbeats', '0') == '1'
 
     client_addr = f'{ws.scope["client"][0]}:{ws.scope["client"][1]}'
-    print(f'/bridge: accepted a connection with a worker: {worker_id}, ip addr: {client_addr}, build_env: {build_env}')
+    logger.info('accepted a connection with a worker', extra=log.fields(worker_id=worker_id, addr=client_addr, build_env=build_env, slots=slots,
+                                                                        flow_control=flow_control, heartbeats=heartbeats))
 
-    workers.manager().register(worker_id, build_env)
+    workers.manager().register(worker_id, build_env, slots, flow_control)
 
-    receive_task = asyncio.create_task(receive_from_client_loop(worker_id, ws))
+    liveness = Liveness(heartbeats)
+    receive_task = asyncio.create_task(receive_from_client_loop(worker_id, ws, liveness))
+    watch_task = asyncio.create_task(watch_loop(worker_id, ws, liveness))
 
     try:
         while True:
             msg: str = await ws.receive_text()
-            msg_json = json.loads(msg)
-            request_id = msg_json["request_id"]
+            liveness.heard()
+            if msg in PONGS:
+                continue
+            if liveness.evicted:
+                break
+            request_id = envelope.request_id_of(msg)
 
-            print(f"/bridge: received message from worker {worker_id} to request {request_id}: {msg[:48]}")
+            if log.relay_debug and log.sampled():
+                logger.debug('received message from worker', extra=log.fields(request_id=request_id, worker_id=worker_id, msg=msg))
 
-            workers.manager().send_to_client(request_id, worker_id, msg)
+            try:
+                workers.manager().send_to_client(request_id, worker_id, msg)
+            except Exception as e:
+                # e.g. late output of a run that has been closed, the worker's other runs go on
+                logger.warning('%s', e, extra=log.fields(request_id=request_id, worker_id=worker_id))
 
     except websocket.DisconnectError:
-        print(f'/bridge: worker {worker_id} disconnected')
+        logger.info('worker disconnected', extra=log.fields(worker_id=worker_id))
     except Exception as e:
-        print(f'/bridge: exception: {e}')
+        logger.exception('exception', extra=log.fields(worker_id=worker_id))
 
     receive_task.cancel()
     await receive_task
-    workers.manager().unregister(worker_id)
-    print(f'/bridge: exit for worker {worker_id}')
+    watch_task.cancel()
+    if not liveness.evicted:
+        workers.manager().unregister(worker_id)
+    logger.info('exit', extra=log.fields(worker_id=worker_id))
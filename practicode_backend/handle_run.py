@@ -1,21 +1,241 @@
+from django.conf import settings
 from . import workers
 from . import websocket
 from . import test_cases
-import ujson as json
+from . import envelope
+from . import result_cache
+from . import log
+from . import metrics
+from . import tracing
+from . import client_id
 import asyncio
+import collections
 import time
+from typing import Deque, Dict, List, Optional
 
+logger = log.get('run')
+
+QUEUE_TIMEOUTS = metrics.counter('practicode_queue_timeouts_total', 'Requests that gave up waiting for a worker', ('build_env',))
+CLIENT_DISCONNECTS = metrics.counter('practicode_client_disconnects_total', 'Clients that disconnected before their run finished')
+RUN_WORKER_DISCONNECTS = metrics.counter('practicode_run_worker_disconnects_total', 'Runs whose worker disconnected before finishing')
+REDISPATCHES = metrics.counter('practicode_run_redispatches_total', 'Runs given to another worker because theirs disconnected before any output')
+RESUMES = metrics.counter('practicode_run_resumes_total', 'Clients that reconnected to their run', ('result',))
 
-MAX_WAIT_IN_FIRST_LINE = 20.0 # in seconds
 
-def wait_time_for(queue_size: int) -> float:
-    if queue_size > 30:
-        return 1.0
-    elif queue_size > 20:
-        return 0.5
-    elif queue_size > 10:
-        return 0.25
-    return 0.15
+MAX_WAIT_IN_FIRST_LINE = 20.0 # in seconds
+MAX_WAIT_IN_QUEUE = 120.0 # in seconds, the deadline of a request for getting a worker
+QUEUE_KEEPALIVE_INTERVAL = 10.0 # in seconds, the position is sent again that often if it doesn't change, to notice gone clients
+SUBMISSION_WAIT = 1.0 # in seconds, how long a run of a cached target waits for the submission before queueing
+MAX_REDISPATCHES = 2 # how many times a run is given to another worker
+MAX_REPLAY_MESSAGES = 100 # a run that has sent more to its worker before any output isn't given to another one
+COALESCE_WINDOW = 0.005 # in seconds, how long output waits for more to be sent with it to a client that asked for batches
+COALESCE_MAX_BYTES = 16 * 1024 # a batch of output is sent right away once it's that big
+
+
+class Replay:
+    # messages to the worker of a run until its first output, to send them to another worker if that one fails before it
+    def __init__(self):
+        self.messages: List = []
+        self.active = True
+
+    def send(self, bridge: workers.Bridge, msg):
+        bridge.send_to_worker(msg)
+        if self.active:
+            self.messages.append(msg)
+            if len(self.messages) > MAX_REPLAY_MESSAGES:
+                self.stop()
+
+    def stop(self):
+        self.active = False
+        self.messages = []
+
+
+class Flush(Exception):
+    # interrupts the relay of a run to send the output it has batched
+    pass
+
+
+class Coalescer:
+    # merges consecutive output of a run into one JSON array for clients that connect with ?batch=1,
+    # so that a program printing line by line costs a websocket message per few milliseconds, not per line
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.frames: List[str] = []
+        self.size = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def add(self, msg: str) -> Optional[str]:
+        # the batch to send if it's full
+        self.frames.append(msg)
+        self.size += len(msg)
+        if self.size >= COALESCE_MAX_BYTES:
+            return self.take()
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(COALESCE_WINDOW, self.bridge.interrupt, Flush())
+        return None
+
+    def take(self) -> Optional[str]:
+        if self.timer is not None:
+            self.timer.cancel() # a Flush that is queued already finds nothing to send
+            self.timer = None
+        if not self.frames:
+            return None
+        batch = '[' + ','.join(self.frames) + ']'
+        self.frames = []
+        self.size = 0
+        return batch
+
+
+class Resumed(Exception):
+    # interrupts the relay of a run to switch it to the client's new connection
+    pass
+
+
+class Expired(Exception):
+    # interrupts the relay of a run whose client hasn't come back in time
+    pass
+
+
+class Session:
+    # the client's side of a run, it outlives the client's connection for settings.RUN_RESUME_GRACE seconds:
+    # the output is numbered from 0, a batch of it counts as one, and the latest of it is kept, a client that reconnects with ?resume=<n>
+    # gets the output from number n on and the run goes on as if the connection hadn't dropped
+    def __init__(self, request_id: str, ws: websocket.WebSocket, query: tuple):
+        self.request_id = request_id
+        self.query = query # (task_id, target, build_env) of the run, a resume must repeat them
+        self.ws: Optional[websocket.WebSocket] = ws # None while the client is away
+        self.pending_ws: Optional[websocket.WebSocket] = None # the connection of a resume, until the relay switches to it
+        self.resumable = settings.RUN_RESUME_GRACE > 0
+        self.bridge = None
+        self.buffer: Deque[str] = collections.deque()
+        self.buffered_bytes = 0
+        self.first_seq = 0 # the number of the first buffered message
+        self.seq = 0 # the number of the next message
+        self.resume_from = 0
+        self.switch_needed = False
+        self.expired = False
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.wakeup: Optional[asyncio.Future] = None
+        self.done = asyncio.get_running_loop().create_future() # resumed connections stay open until the run ends
+        if self.resumable and request_id not in sessions:
+            sessions[request_id] = self
+
+    def attach_bridge(self, bridge):
+        self.bridge = bridge
+        if self.expired:
+            bridge.interrupt(Expired())
+        elif self.switch_needed:
+            bridge.interrupt(Resumed())
+
+    async def send(self, msg: str):
+        if self.resumable:
+            self.buffer.append(msg)
+            self.buffered_bytes += len(msg)
+            self.seq += 1
+            while self.buffered_bytes > settings.RUN_RESUME_BUFFER_BYTES and len(self.buffer) > 1:
+                self.buffered_bytes -= len(self.buffer.popleft())
+                self.first_seq += 1
+        ws = self.ws
+        if ws is None:
+            return
+        try:
+            await ws.send_text(msg)
+        except Exception as e:
+            if not self.resumable:
+                raise
+            logger.info('couldn\'t send to the client: %s', e, extra=log.fields(request_id=self.request_id))
+            self.client_gone(ws)
+
+    def client_gone(self, ws: websocket.WebSocket):
+        if ws is not self.ws:
+            return # a connection that has been replaced
+        if not self.resumable:
+            self.bridge.interrupt(websocket.DisconnectError()) # the relay stops and the run is cancelled, even if the worker is silent
+            return
+        logger.info('client disconnected, keeps the run for a while', extra=log.fields(request_id=self.request_id))
+        self.ws = None
+        self.timer = asyncio.get_running_loop().call_later(settings.RUN_RESUME_GRACE, self.expire)
+
+    def resumable_by(self, query: tuple) -> bool:
+        # a connection that is still live is never replaced, and the client must know more than the request_id
+        return not self.expired and self.ws is None and self.pending_ws is None and query == self.query
+
+    def resume(self, ws: websocket.WebSocket, seq: int):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # the output that comes before the relay switches is only buffered, the switch sends it from resume_from on
+        self.pending_ws = ws
+        self.resume_from = seq
+        self.switch_needed = True
+        self._wake(Resumed())
+
+    def expire(self):
+        self.timer = None
+        self.expired = True
+        self._wake(Expired())
+
+    def _wake(self, error: Exception):
+        if self.wakeup is not None:
+            if not self.wakeup.done():
+                self.wakeup.set_result(None)
+        elif self.bridge is not None:
+            self.bridge.interrupt(error)
+        # otherwise a bridge is being waited for, attach_bridge() interrupts it
+
+    async def switch(self):
+        # sends the output the client has missed to its new connection
+        self.switch_needed = False
+        ws = self.ws = self.pending_ws
+        self.pending_ws = None
+        if self.resume_from < self.first_seq:
+            RESUMES.labels('gap').inc()
+            logger.info('some output is no longer buffered', extra=log.fields(request_id=self.request_id, resume_from=self.resume_from, first_seq=self.first_seq))
+            try:
+                await send_output_lost_error(ws)
+            except Exception:
+                self.client_gone(ws)
+                return
+        else:
+            RESUMES.labels('resumed').inc()
+        for msg in list(self.buffer)[max(self.resume_from - self.first_seq, 0):]:
+            try:
+                await ws.send_text(msg)
+            except Exception:
+                self.client_gone(ws)
+                return
+
+    async def linger(self):
+        # the run has finished while the client was away, it can still come for the rest
+        self.bridge = None
+        while not self.expired:
+            if self.switch_needed:
+                await self.switch()
+            if self.ws is not None:
+                return
+            self.wakeup = asyncio.get_running_loop().create_future()
+            await self.wakeup
+            self.wakeup = None
+
+    def end(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if sessions.get(self.request_id) is self:
+            del sessions[self.request_id]
+        self.done.set_result(None)
+
+
+sessions: Dict[str, Session] = {} # by request_id
+
+
+async def close_quietly(ws: websocket.WebSocket):
+    if not ws.connected:
+        return
+    try:
+        await ws.close()
+    except Exception:
+        pass # the server has dropped the connection already
 
 
 async def send_missing_query_parameter_error(param_name: str, ws: websocket.WebSocket):
@@ -34,63 +254,174 @@ async def send_cant_build_bridge_error(build_env: str, ws: websocket.WebSocket):
     await ws.send_json(msg)
 
 
-async def send_worker_disconnected_error(ws: websocket.WebSocket):
+async def send_rejected_error(retry_after: float, ws: websocket.WebSocket):
     msg = {
-        'description': 'Worker has disconnected, please, try again',
+        'description': f'Too many requests are waiting for a worker, please, try again in {retry_after:.0f} seconds',
         'stage': 'backend',
+        'retry_after': round(retry_after),
     }
     await ws.send_json(msg)
 
 
-async def wait_in_queue(request_id: str, build_env: str, ws: websocket.WebSocket):
-    last_feedback_time = time.time() - 10.1
-    # wait in a queue and periodically send a position in the queue to the client
-    while True:
-        q = workers.manager().queue_number(request_id, build_env)
-        if q > 0:
-            t = time.time()
-            if t - last_feedback_time > 2.0:
-                print(f'/run: request {request_id} is number {q} in a queue')
-                await ws.send_json({'queue': q + 1}) # send queue position to the client
-                last_feedback_time = t
-            await asyncio.sleep(wait_time_for(q + 1))
-        else:
-            break
-    # we're number 1 in the queue, but probably we'll need to wait for a free worker
-    start_time = time.time()
-    while True:
-        bridge = workers.manager().make_bridge(request_id, build_env)
-        if bridge is None: # can't make a bridge, every worker is busy
-            t = time.time()
-            if t - last_feedback_time > 2.0:
-                print(f"/run: request {request_id} is number 1 in a queue")
-                await ws.send_json({'queue': 1})
-                last_feedback_time = t
-
-            if t - start_time > MAX_WAIT_IN_FIRST_LINE:
-                await send_cant_build_bridge_error(build_env, ws)
-                raise Exception('couldn\'t build a bridge in a reasonable time')
-            await asyncio.sleep(0.01)
-        else:
-            return bridge
+async def send_run_abandoned_error(ws: websocket.WebSocket):
+    msg = {
+        'description': 'The identical run this request was joined to has stopped, please, try again',
+        'stage': 'backend',
+    }
+    await ws.send_json(msg)
 
 
-async def receive_from_client_loop(request_id: str, bridge: workers.Bridge, ws: websocket.WebSocket):
-    # loop for messages from the client
-    while True:
-        msg: str = await ws.receive_text()
-        msg_json = json.loads(msg) # TODO: delete because it's wasty
-        request_id = msg_json['request_id']
+async def send_not_resumable_error(ws: websocket.WebSocket):
+    msg = {
+        'description': 'The run can\'t be resumed anymore, please, try again',
+        'stage': 'backend',
+    }
+    await ws.send_json(msg)
 
-        print(f'/run: sending message from request {request_id} to worker {bridge.worker.worker_id}: {msg[:38]}')
-        bridge.send_to_worker(msg)
 
+async def send_output_lost_error(ws: websocket.WebSocket):
+    msg = {
+        'description': 'Some output has been lost while the connection was down',
+        'stage': 'backend',
+    }
+    await ws.send_json(msg)
 
-async def send_test_cases(bridge: workers.Bridge, request_id: str, task_id: str):
-    print(f'/run: sending test suite')
-    test_cases_json = json.loads(test_cases.load_for(task_id))
-    test_cases_json['request_id'] = request_id
-    bridge.send_to_worker(test_cases_json)
+
+async def send_worker_disconnected_error(ws: websocket.WebSocket):
+    msg = {
+        'description': 'Worker has disconnected, please, try again',
+        'stage': 'backend',
+    }
+    await ws.send_json(msg)
+
+
+async def wait_in_queue(ticket: workers.Ticket, ws: Optional[websocket.WebSocket]) -> workers.Bridge:
+    # the manager resolves the ticket as soon as a worker is free, meanwhile send the client its position in the queue when it changes,
+    # unless the client is away
+    sent_position = None
+    sent_at = 0.0
+    while not ticket.bridge.done():
+        q = workers.manager().queue_number(ticket)
+        if ws is not None and q is not None and (q != sent_position or time.time() - sent_at >= QUEUE_KEEPALIVE_INTERVAL):
+            msg = {'queue': q + 1} # send queue position to the client
+            wait = workers.manager().estimated_wait(ticket)
+            if wait is not None:
+                msg['estimated_wait'] = round(wait, 1) # in seconds
+            logger.debug('waiting in a queue', extra=log.fields(request_id=ticket.request_id, position=q + 1, estimated_wait=wait))
+            await ws.send_json(msg)
+            sent_position, sent_at = q, time.time()
+
+        time_left = ticket.deadline - time.time()
+        if ticket.head_since is not None:
+            # we're number 1 in the queue, but every worker is busy
+            time_left = min(time_left, ticket.head_since + MAX_WAIT_IN_FIRST_LINE - time.time())
+        if time_left <= 0:
+            QUEUE_TIMEOUTS.labels(workers.manager().build_env_label(ticket.build_env)).inc()
+            if ws is not None:
+                await send_cant_build_bridge_error(ticket.build_env, ws)
+            raise Exception('couldn\'t build a bridge in a reasonable time')
+        await workers.wait_for_ticket(ticket, min(QUEUE_KEEPALIVE_INTERVAL, time_left))
+    return ticket.bridge.result()
+
+
+async def receive_from_client_loop(request_id: str, bridge: workers.Bridge, ws: websocket.WebSocket, run: result_cache.SharedRun = None,
+                                   replay: Optional[Replay] = None, session: Optional[Session] = None):
+    # loop for messages from the client
+    while True:
+        await bridge.wait_for_room_to_worker() # don't read from the client while the worker doesn't keep up
+        try:
+            msg: str = await ws.receive_text()
+        except websocket.DisconnectError as e:
+            if session is not None:
+                session.client_gone(ws)
+            else:
+                bridge.interrupt(e) # the relay of the worker's output stops and the run is cancelled, even if the worker is silent
+            return
+        if envelope.client_request_id(msg) != request_id:
+            # a worker runs several requests at once, don't let a client talk to somebody else's run
+            logger.warning('a message for another request, dropping it', extra=log.fields(request_id=request_id, msg=msg))
+            continue
+        if run:
+            run.abandon() # the output depends on more than the submission now
+
+        if log.relay_debug and log.sampled():
+            logger.debug('sending message to worker', extra=log.fields(request_id=request_id, worker_id=bridge.worker_id, msg=msg))
+        if replay is not None:
+            replay.send(bridge, msg)
+        else:
+            bridge.send_to_worker(msg)
+
+
+async def resume_session(request_id: str, resume: str, query: tuple, ws: websocket.WebSocket):
+    # a client reconnects to its run, the connection stays open until the run ends
+    session = sessions.get(request_id)
+    if session is None or not session.resumable_by(query) or not resume.isdecimal() or int(resume) > session.seq:
+        logger.info('nothing to resume', extra=log.fields(request_id=request_id, resume=resume))
+        RESUMES.labels('unknown').inc()
+        await send_not_resumable_error(ws)
+        await ws.close()
+        return
+    logger.info('resumes its run', extra=log.fields(request_id=request_id, resume=resume))
+    session.resume(ws, int(resume))
+    await session.done
+    await close_quietly(ws)
+
+
+async def receive_submission(request_id: str, ws: websocket.WebSocket) -> str:
+    # the first message of the client, None if it doesn't come right away
+    try:
+        msg: str = await asyncio.wait_for(ws.receive_text(), SUBMISSION_WAIT)
+    except asyncio.TimeoutError:
+        return None
+    if envelope.client_request_id(msg) != request_id:
+        logger.warning('a message for another request, dropping it', extra=log.fields(request_id=request_id, msg=msg))
+        return None
+    return msg
+
+
+def batched(msgs: List[str]) -> List[str]:
+    # JSON arrays of the messages, each about COALESCE_MAX_BYTES at most, as Coalescer sends them
+    batches = []
+    start = size = 0
+    for i, msg in enumerate(msgs):
+        size += len(msg)
+        if size >= COALESCE_MAX_BYTES or i == len(msgs) - 1:
+            batches.append('[' + ','.join(msgs[start:i + 1]) + ']')
+            start, size = i + 1, 0
+    return batches
+
+
+async def replay_result(request_id: str, frames, ws: websocket.WebSocket, batch: bool = False):
+    await ws.send_text('{"ping":"1"}')
+    msgs = [envelope.with_request_id(rest, request_id) for rest in frames]
+    for msg in batched(msgs) if batch else msgs:
+        await ws.send_text(msg)
+
+
+async def follow_run(request_id: str, frames: asyncio.Queue, ws: websocket.WebSocket, batch: bool = False) -> bool:
+    # relays the output of an identical run, returns False if that run was abandoned before anything was relayed;
+    # for a client that asked for batches, the output that has come meanwhile is sent as one
+    await ws.send_text('{"ping":"1"}')
+    relayed = False
+    while True:
+        frame = await frames.get()
+        msgs = []
+        while frame is not None:
+            rest, finish = frame
+            msgs.append(envelope.with_request_id(rest, request_id))
+            if finish or not batch or frames.empty():
+                break
+            frame = frames.get_nowait()
+        for msg in batched(msgs) if batch else msgs:
+            await ws.send_text(msg)
+        relayed = relayed or bool(msgs)
+        if frame is None:
+            if relayed:
+                await send_run_abandoned_error(ws)
+                return True
+            return False
+        if finish:
+            return True
 
 
 async def handle(ws: websocket.WebSocket):
@@ -112,62 +443,219 @@ async def handle(ws: websocket.WebSocket):
     if request_id == '':
         return await send_missing_query_parameter_error('request_id', ws)
 
-    print(f'/run: accepted a connection with a request {request_id}, task_id: {task_id}, build_env: {build_env}, target: {target}')
+    batch = ws.query_params.get('batch', '0') == '1' # output may come as arrays of messages
+    resume = ws.query_params.get('resume', '')
+    if resume != '':
+        return await resume_session(request_id, resume, (task_id, target, build_env), ws)
+
+    # requests of one user take turns with the others' in the queue, a user is known by the id the server has given it:
+    # user_id is chosen by the client, a new one per request would jump the queue
+    user = client_id.of_connection(ws)
+    user_id = ws.query_params.get('user_id', '') # only logged
+    priority_class = settings.RUN_PRIORITY_TOKENS.get(ws.query_params.get('priority_token', ''), 'student')
+    priority = workers.PRIORITIES.get(priority_class, workers.DEFAULT_PRIORITY)
 
-    workers.manager().put_in_queue(request_id, build_env)
+    logger.info('accepted a connection', extra=log.fields(request_id=request_id, task_id=task_id, build_env=build_env, target=target,
+                                                          user=user, user_id=user_id, priority=priority_class))
 
+    trace = tracing.tracer().start(request_id, task_id=task_id, build_env=build_env, target=target)
+    outcome = 'error'
+    ticket = None
     receive_task = None
     bridge = None
+    session = None
+    coalescer = None
+    run = None # a run identical requests can follow, if this request has started one
+    key = followed = None
     try:
-        bridge = await wait_in_queue(request_id, build_env, ws)
-        worker_id = bridge.worker.worker_id
-        print(f'/run: request {request_id} has started being served')
-
-        await ws.send_text('{"ping":"1"}') # it's hack to have an exception here if the connection is closed for some reason
-
-        # separate loop for messages from the client
-        receive_task = asyncio.create_task(receive_from_client_loop(request_id, bridge, ws))
-
-        # the initial message must be {"command": "new", "request_id": "..."}
-        bridge.send_to_worker({
-            'command': 'new',
-            'request_id': request_id,
-            'target': target
-        })
-
-        # send test cases if needed
-        if 'tests' in target:
-            await send_test_cases(bridge, request_id, task_id)
-
-        # messages from the worker
+        # loaded before the run starts, so the suite reaches the worker right after `new`
+        suite = await test_cases.load_for(task_id) if 'tests' in target else None
+
+        submission = None
+        if result_cache.enabled_for(target):
+            submission = await receive_submission(request_id, ws)
+            if submission is not None:
+                key = result_cache.key_for(task_id, build_env, target, suite, submission)
+                while True:
+                    frames = result_cache.cache().get(key)
+                    if frames is not None:
+                        logger.info('served from the result cache', extra=log.fields(request_id=request_id))
+                        await replay_result(request_id, frames, ws, batch)
+                        await ws.close()
+                        tracing.tracer().finish(trace, 'cache_hit')
+                        return
+
+                    followed = result_cache.cache().follow(key, request_id)
+                    if followed is None:
+                        run = result_cache.cache().start(key)
+                        break
+                    logger.info('follows an identical run', extra=log.fields(request_id=request_id))
+                    trace.mark('following')
+                    if await follow_run(request_id, followed, ws, batch):
+                        await ws.close()
+                        tracing.tracer().finish(trace, 'followed')
+                        return
+                    followed = None
+                    # the run has been abandoned before it produced anything, try again
+
+        # until the first output, the run is given to another worker if its worker disconnects or stalls
+        replay = Replay()
+        redispatches = 0
+        session = Session(request_id, ws, (task_id, target, build_env))
         while True:
-            msg: str = await bridge.receive_from_worker()
-            msg_json = json.loads(msg)
-            msg_request_id = msg_json["request_id"]
-            assert msg_request_id == request_id
-
-            print(f'/run: received message from worker {worker_id} to request {request_id}: {msg[:38]}')
-
-            await ws.send_text(msg)
-
-            if msg_json.get("finish", None) == True:
-                print(f'/run: received finish from worker {worker_id} to request {request_id}, will close')
+            # workers that have recently run the same task and target are preferred, their build caches are warm
+            ticket = workers.manager().put_in_queue(request_id, build_env, user, priority, time.time() + MAX_WAIT_IN_QUEUE, f'{task_id}/{target}')
+            trace.mark('enqueued')
+            bridge = await wait_in_queue(ticket, session.ws)
+            session.attach_bridge(bridge)
+            if ticket.head_since is not None:
+                trace.mark('head_of_queue', ticket.head_since)
+            trace.mark('bridged')
+            if tracing.tracer().enabled():
+                bridge.attach_trace(trace)
+            worker_id = bridge.worker_id
+            logger.info('started being served', extra=log.fields(request_id=request_id, worker_id=worker_id))
+
+            if redispatches == 0:
+                await ws.send_text('{"ping":"1"}') # it's hack to have an exception here if the connection is closed for some reason
+
+                # the initial message must be {"command": "new", "request_id": "..."}
+                replay.send(bridge, {
+                    'request_id': request_id,
+                    'command': 'new',
+                    'target': target
+                })
+                trace.mark('new_sent')
+
+                # send test cases if needed
+                if suite is not None:
+                    logger.debug('sending test suite', extra=log.fields(request_id=request_id, suite=suite.path))
+                    replay.send(bridge, suite.message_for(request_id))
+
+                if submission is not None:
+                    replay.send(bridge, submission)
+            else:
+                for msg in replay.messages:
+                    bridge.send_to_worker(msg)
+
+            if batch:
+                coalescer = Coalescer(bridge)
+
+            # separate loop for messages from the client
+            if session.ws is not None:
+                receive_task = asyncio.create_task(receive_from_client_loop(request_id, bridge, session.ws, run, replay, session))
+
+            try:
+                # messages from the worker
+                while True:
+                    try:
+                        msg: str = await bridge.receive_from_worker()
+                    except Resumed:
+                        if session.switch_needed:
+                            trace.mark('resumed')
+                            if receive_task:
+                                receive_task.cancel()
+                            await session.switch()
+                            receive_task = None
+                            if session.ws is not None:
+                                receive_task = asyncio.create_task(receive_from_client_loop(request_id, bridge, session.ws, run, replay, session))
+                        continue
+                    except Expired:
+                        raise websocket.DisconnectError()
+                    except Flush:
+                        frames = coalescer.take()
+                        if frames is not None:
+                            await session.send(frames)
+                        continue
+                    msg_request_id, finish = envelope.peek(msg)
+                    assert msg_request_id == request_id
+                    if replay.active:
+                        replay.stop()
+                    trace.mark('first_output')
+
+                    if log.relay_debug and log.sampled():
+                        logger.debug('received message from worker', extra=log.fields(request_id=request_id, worker_id=worker_id, msg=msg))
+
+                    if coalescer is None:
+                        await session.send(msg)
+                    else:
+                        frames = coalescer.add(msg)
+                        if finish and frames is None:
+                            frames = coalescer.take()
+                        if frames is not None:
+                            await session.send(frames)
+                    if run:
+                        run.publish(msg, finish)
+
+                    if finish:
+                        logger.info('received finish, will close', extra=log.fields(request_id=request_id, worker_id=worker_id))
+                        trace.mark('finish')
+                        outcome = 'finished'
+                        break
                 break
+            except workers.DisconnectError:
+                if coalescer is not None:
+                    frames = coalescer.take() # the output so far goes before the error
+                    if frames is not None:
+                        await session.send(frames)
+                if not replay.active or redispatches >= MAX_REDISPATCHES:
+                    raise
+
+            logger.warning('worker disconnected before any output, giving the run to another one', extra=log.fields(request_id=request_id, worker_id=worker_id))
+            REDISPATCHES.labels().inc()
+            trace.mark('redispatched')
+            redispatches += 1
+            if receive_task:
+                receive_task.cancel()
+            receive_task = None
+            bridge.close()
+            workers.manager().remove_bridge(bridge)
+            bridge = ticket = session.bridge = None
     except websocket.DisconnectError:
-        print(f'/run: request {request_id} disconnected')
+        logger.info('client disconnected', extra=log.fields(request_id=request_id))
+        CLIENT_DISCONNECTS.labels().inc()
+        outcome = 'client_disconnected'
+    except workers.RejectedError as e:
+        logger.info('rejected, the queue is too long', extra=log.fields(request_id=request_id, retry_after=e.retry_after))
+        outcome = 'rejected'
+        try:
+            if session.ws is not None:
+                await send_rejected_error(e.retry_after, session.ws)
+        except websocket.DisconnectError:
+            logger.info('client disconnected too', extra=log.fields(request_id=request_id))
     except workers.DisconnectError:
-        print(f'/run: request {request_id} found out that worker disconnected')
+        logger.warning('worker disconnected', extra=log.fields(request_id=request_id))
+        RUN_WORKER_DISCONNECTS.labels().inc()
+        outcome = 'worker_disconnected'
         try:
-            await send_worker_disconnected_error(ws)
+            if session.ws is not None:
+                await send_worker_disconnected_error(session.ws)
         except websocket.DisconnectError:
-            print(f'/run: request {request_id} disconnected too')
+            logger.info('client disconnected too', extra=log.fields(request_id=request_id))
     except Exception as e:
-        print(f'/run: request {request_id}, exception: {e}')
+        logger.warning('exception: %s', e, extra=log.fields(request_id=request_id))
 
+    if run:
+        result_cache.cache().end(run) # caches the output or lets the followers run on their own
+    if followed:
+        result_cache.cache().unfollow(key, request_id)
     if receive_task:
         receive_task.cancel()
-    await ws.close()
+    if coalescer:
+        coalescer.take()
+    if bridge is None and ticket is not None:
+        bridge = workers.manager().leave_queue(ticket) # a worker could have been given to us right before we gave up
     if bridge:
-        bridge.close()
-        workers.manager().remove_bridge(bridge)
-    print(f'/run: closed request {request_id}')
+        if outcome == 'finished':
+            bridge.close()
+            workers.manager().remove_bridge(bridge)
+        else:
+            workers.manager().cancel(bridge) # the worker stops the run, its slot is freed once it has
+    if session:
+        if outcome == 'finished' and session.ws is None:
+            trace.mark('detached')
+            await session.linger()
+        session.end()
+    await close_quietly(ws)
+    tracing.tracer().finish(trace, outcome)
+    logger.info('closed', extra=log.fields(request_id=request_id))
@@ -0,0 +1,84 @@
+# Logging of the server, written to stdout by a separate thread so the event loop never blocks on it.
+#
+# Records are put into a queue as they are and formatted by the writer thread, fields of a record
+# are passed as extra=log.fields(...). Relayed messages are logged at debug level and only every
+# LOG_RELAY_SAMPLE-th of them, the relay path checks `log.relay_debug` before building anything.
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+RELAY_SAMPLE = max(1, int(os.getenv('LOG_RELAY_SAMPLE', '1'))) # log one of that many relayed messages
+FIELD_MAX_LENGTH = 48 # longer field values, e.g. relayed messages, are cut
+
+root = logging.getLogger('practicode')
+listener = None
+relay_debug = False # whether relayed messages are logged at all, set by setup()
+relayed = 0
+
+
+def get(name: str) -> logging.Logger:
+    return root.getChild(name)
+
+
+def fields(**kwargs) -> dict:
+    return {'fields': kwargs}
+
+
+def sampled() -> bool:
+    # true for one of RELAY_SAMPLE relayed messages
+    global relayed
+    relayed += 1
+    return relayed % RELAY_SAMPLE == 0
+
+
+class Formatter(logging.Formatter):
+    # `<time> <level> <logger>: <message> key=value ...`
+    def format(self, record: logging.LogRecord) -> str:
+        line = f'{self.formatTime(record)} {record.levelname} {record.name}: {record.getMessage()}'
+        record_fields = getattr(record, 'fields', None)
+        if record_fields:
+            parts = [line]
+            for key, value in record_fields.items():
+                value = str(value)
+                if len(value) > FIELD_MAX_LENGTH:
+                    value = value[:FIELD_MAX_LENGTH] + '...'
+                parts.append(f'{key}={value}')
+            line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the base class formats the record here, in the caller's thread, the writer thread does it instead
+        return record
+
+
+def setup():
+    global listener, relay_debug
+    if listener is not None:
+        return
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(Formatter())
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    atexit.register(shutdown)
+
+    root.addHandler(QueueHandler(records))
+    root.setLevel(LEVEL)
+    root.propagate = False
+    relay_debug = root.isEnabledFor(logging.DEBUG)
+
+
+def shutdown():
+    # writes out what's left in the queue
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
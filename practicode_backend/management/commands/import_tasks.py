@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import os
+from practicode_backend import task_store
+
+
+class Command(BaseCommand):
+    help = 'Compiles tasks and test suites from templates/tasks into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=os.path.join(settings.BASE_DIR, 'practicode_backend', 'templates', 'tasks'))
+
+    def handle(self, *args, **options):
+        n_tasks, n_suites = task_store.import_from_files(options['dir'])
+        self.stdout.write(f'Imported {n_tasks} tasks and {n_suites} test suites')
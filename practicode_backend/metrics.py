@@ -0,0 +1,126 @@
+# Metrics of the server in the Prometheus text exposition format, served on GET /metrics.
+#
+# Counters and histograms are plain numbers updated by the code that does the work: everything runs
+# on one event loop, so there are no locks, and the relay path resolves its counters once, on import.
+# Gauges are filled by collectors, which read the state of the manager only when /metrics is scraped.
+import bisect
+from typing import Callable, Dict, List, Tuple
+
+# in seconds, from a ping-pong run to a heavy test suite
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Family:
+    # metrics of one name, a child per combination of label values
+    def __init__(self, name: str, kind: str, help: str, labels: Tuple[str, ...], make: Callable):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.label_names = labels
+        self.make = make
+        self.children: Dict[tuple, object] = {}
+        if not labels:
+            self.labels() # exported as 0 from the start
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.make()
+        return child
+
+    def clear(self):
+        # gauges are set anew on every scrape, so label values that went away disappear
+        self.children = {}
+
+    def _labels_text(self, values: tuple, extra: str = '') -> str:
+        pairs = [f'{name}="{escape(value)}"' for name, value in zip(self.label_names, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self, lines: List[str]):
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} {self.kind}')
+        for values, child in sorted(self.children.items()):
+            if self.kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip(self.buckets_of(child), child.counts):
+                    cumulative += count
+                    le = 'le="' + bound + '"'
+                    lines.append(f'{self.name}_bucket{self._labels_text(values, le)} {cumulative}')
+                lines.append(f'{self.name}_sum{self._labels_text(values)} {child.sum}')
+                lines.append(f'{self.name}_count{self._labels_text(values)} {child.count}')
+            else:
+                lines.append(f'{self.name}{self._labels_text(values)} {child.value}')
+
+    @staticmethod
+    def buckets_of(histogram: Histogram) -> List[str]:
+        return [str(b) for b in histogram.buckets] + ['+Inf']
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+families: List[Family] = []
+collectors: List[Callable[[], None]] = []
+
+
+def counter(name: str, help: str, labels: Tuple[str, ...] = ()) -> Family:
+    return register(Family(name, 'counter', help, labels, Counter))
+
+
+def gauge(name: str, help: str, labels: Tuple[str, ...] = ()) -> Family:
+    return register(Family(name, 'gauge', help, labels, Gauge))
+
+
+def histogram(name: str, help: str, labels: Tuple[str, ...] = ()) -> Family:
+    return register(Family(name, 'histogram', help, labels, Histogram))
+
+
+def register(family: Family) -> Family:
+    families.append(family)
+    return family
+
+
+def add_collector(collect: Callable[[], None]):
+    # `collect` sets gauges from the current state, it's called on every scrape
+    collectors.append(collect)
+
+
+def render() -> str:
+    for collect in collectors:
+        collect()
+    lines: List[str] = []
+    for family in families:
+        family.render(lines)
+    return '\n'.join(lines) + '\n'
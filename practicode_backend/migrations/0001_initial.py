@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('task_id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('title', models.CharField(max_length=255)),
+                ('lang', models.CharField(max_length=64)),
+                ('build_env', models.CharField(max_length=64)),
+                ('text', models.TextField()),
+                ('code', models.TextField()),
+                ('body', models.BinaryField()),
+                ('etag', models.CharField(max_length=64)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TestSuite',
+            fields=[
+                ('suite_id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('text', models.TextField()),
+                ('version', models.CharField(max_length=64)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['lang', 'build_env'], name='practicode__lang_af6783_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['build_env'], name='practicode__build_e_c175b3_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import models
+
+
+class Task(models.Model):
+    # a task compiled from templates/tasks/<task_id>.html by `manage.py import_tasks`
+    task_id = models.CharField(max_length=255, primary_key=True)
+    title = models.CharField(max_length=255)
+    lang = models.CharField(max_length=64)
+    build_env = models.CharField(max_length=64)
+    text = models.TextField()
+    code = models.TextField()
+    body = models.BinaryField() # ready to send response of GET /tasks/<task_id>
+    etag = models.CharField(max_length=64)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['lang', 'build_env']),
+            models.Index(fields=['build_env']),
+        ]
+
+
+class TestSuite(models.Model):
+    # a test suite from templates/tasks/<suite_id>.tests.json, suite_id is a task_id or 'default'
+    suite_id = models.CharField(max_length=255, primary_key=True)
+    text = models.TextField()
+    version = models.CharField(max_length=64)
+    updated_at = models.DateTimeField(auto_now=True)
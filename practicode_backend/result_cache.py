@@ -0,0 +1,182 @@
+# Cache of finished runs for targets that are deterministic (settings.RESULT_CACHE_TARGETS).
+#
+# A run is keyed by task_id, build_env, target, the test suite version and the hash of the submission,
+# the first message of the client with its request id stripped. The messages of a run from the worker
+# are recorded without the request id, on a hit they are replayed to the client with its own one.
+# Identical requests that come while such a run is still queued or running follow its output instead
+# of taking a worker of their own.
+from django.conf import settings
+import asyncio
+import collections
+import hashlib
+from typing import Dict, List, Optional
+from . import envelope
+from . import metrics
+from . import test_cases
+from . import workers
+
+
+def enabled_for(target: str) -> bool:
+    return target in settings.RESULT_CACHE_TARGETS
+
+
+def key_for(task_id: str, build_env: str, target: str, suite: Optional[test_cases.TestSuite], submission: str) -> str:
+    h = hashlib.sha256()
+    for part in (task_id, build_env, target, suite.version if suite else '', envelope.strip_request_id(submission)):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class Recording:
+    # messages of a run from the worker, kept without the request id so they can be replayed to another request
+    def __init__(self, key: str, max_bytes: int):
+        self.key = key
+        self.max_bytes = max_bytes
+        self.frames: List[str] = []
+        self.size = 0
+        self.tainted = False # the run can't be cached: the client talked to it or the output was too large
+
+    def add(self, msg: str) -> str:
+        rest = envelope.strip_request_id(msg)
+        if self.tainted:
+            return rest
+        if workers.TRUNCATION_NOTICE in msg: # the bridge dropped a part of the output
+            self.taint()
+            return rest
+        self.size += len(rest)
+        if self.size > self.max_bytes:
+            self.taint()
+            return rest
+        self.frames.append(rest)
+        return rest
+
+    def taint(self):
+        self.tainted = True
+        self.frames = []
+
+
+class SharedRun:
+    # a run in progress, its output is fanned out to the followers as (message without request id, finish) pairs
+    def __init__(self, recording: Recording):
+        self.recording = recording
+        self.followers: Dict[str, asyncio.Queue] = {} # by request_id
+        self.finished = False
+
+    def join(self, request_id: str) -> Optional[asyncio.Queue]:
+        if self.recording.tainted or self.finished:
+            return None # the beginning of the output isn't kept or there's nothing to wait for
+        frames = asyncio.Queue()
+        for rest in self.recording.frames:
+            frames.put_nowait((rest, False))
+        self.followers[request_id] = frames
+        return frames
+
+    def leave(self, request_id: str):
+        self.followers.pop(request_id, None)
+
+    def publish(self, msg: str, finish: bool):
+        rest = self.recording.add(msg)
+        for frames in self.followers.values():
+            frames.put_nowait((rest, finish))
+        self.finished = finish
+
+    def abandon(self):
+        # the run won't finish or its output depends on more than the submission, followers get None
+        self.recording.taint()
+        for frames in self.followers.values():
+            frames.put_nowait(None)
+        self.followers = {}
+
+
+class ResultCache:
+    # LRU bounded by the total size of the recorded messages
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: collections.OrderedDict = collections.OrderedDict() # key -> Recording
+        self.running: Dict[str, SharedRun] = {} # key -> the run identical requests can follow
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+    def start(self, key: str) -> SharedRun:
+        run = SharedRun(Recording(key, self.max_bytes // 16))
+        self.running[key] = run
+        return run
+
+    def follow(self, key: str, request_id: str) -> Optional[asyncio.Queue]:
+        run = self.running.get(key)
+        if run is None:
+            return None
+        frames = run.join(request_id)
+        if frames is not None:
+            self.coalesced += 1
+        return frames
+
+    def unfollow(self, key: str, request_id: str):
+        run = self.running.get(key)
+        if run is not None:
+            run.leave(request_id)
+
+    def end(self, run: SharedRun):
+        # called by the request that started the run, however the run has ended
+        if self.running.get(run.recording.key) is run:
+            del self.running[run.recording.key]
+        if run.finished:
+            self.put(run.recording)
+        else:
+            run.abandon()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        recording = self.entries.get(key)
+        if recording is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return recording.frames
+
+    def put(self, recording: Recording):
+        if recording.tainted or recording.key in self.entries:
+            return
+        self.entries[recording.key] = recording
+        self.size += recording.size
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'running': len(self.running),
+            'coalesced': self.coalesced,
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+
+instance = ResultCache(settings.RESULT_CACHE_MAX_BYTES)
+
+def cache():
+    return instance
+
+
+HITS = metrics.counter('practicode_result_cache_hits_total', 'Runs replayed from the result cache')
+MISSES = metrics.counter('practicode_result_cache_misses_total', 'Lookups of runs not in the result cache')
+COALESCED = metrics.counter('practicode_result_cache_coalesced_total', 'Requests that followed an identical run in progress')
+CACHED_BYTES = metrics.gauge('practicode_result_cache_bytes', 'Size of the runs in the result cache')
+
+def collect_metrics():
+    HITS.labels().value = instance.hits
+    MISSES.labels().value = instance.misses
+    COALESCED.labels().value = instance.coalesced
+    CACHED_BYTES.labels().set(instance.size)
+
+metrics.add_collector(collect_metrics)
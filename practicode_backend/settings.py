@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'corsheaders',
+    'practicode_backend',
 ]
 
 MIDDLEWARE = [
@@ -64,10 +65,38 @@ CORS_ALLOWED_ORIGINS = [
     'http://127.0.0.1:8000',
 ]
 
+# the frontend fetches with credentials to keep the cookie that identifies it in the /run queue, see client_id.py
+CORS_ALLOW_CREDENTIALS = True
+
 client_host = os.getenv('CLIENT_HOST')
 if client_host is not None:
     CORS_ALLOWED_ORIGINS.append('http://' + client_host)
 
+# unix socket of the broker hub shared by several server processes, see practicode_backend/broker.py
+BROKER_SOCKET = os.getenv('BROKER_SOCKET')
+
+# compile every task into the in-memory catalog at startup instead of on the first request
+PRELOAD_TASKS = os.getenv('PRELOAD_TASKS', '1') == '1'
+
+# where tasks and test suites are read from: 'files' (templates/tasks) or 'db' (imported with `manage.py import_tasks`)
+TASK_STORE = os.getenv('TASK_STORE', 'files')
+
+# targets whose results only depend on the submission and are replayed from a cache, comma separated, e.g. 'tests'
+RESULT_CACHE_TARGETS = [t for t in os.getenv('RESULT_CACHE_TARGETS', '').split(',') if t]
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# a /run request with ?priority_token=<token> gets the priority class of the token in the wait queue,
+# comma separated <token>:<class>, the classes are 'exam' and 'teacher', everybody else is 'student'
+RUN_PRIORITY_TOKENS = dict(t.split(':', 1) for t in os.getenv('RUN_PRIORITY_TOKENS', '').split(',') if ':' in t)
+
+# GET /debug/* needs 'Authorization: Bearer <token>' with this token, they show request ids of runs; unset turns them off
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN', '')
+
+# a /run request whose client disconnects keeps running that many seconds, 0 turns it off; the client reconnects
+# with the same query and ?resume=<output messages received> and gets the rest, the latest output is kept for that
+RUN_RESUME_GRACE = float(os.getenv('RUN_RESUME_GRACE', '30'))
+RUN_RESUME_BUFFER_BYTES = int(os.getenv('RUN_RESUME_BUFFER_BYTES', str(64 * 1024)))
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -0,0 +1,181 @@
+from django.conf import settings
+from django.db import connections
+from django.template import loader, Template, TemplateDoesNotExist
+import concurrent.futures
+import hashlib
+import os
+import time
+import ujson as json
+from typing import Dict, List, Optional, Tuple
+import pybase64 as base64
+from . import task_store
+from . import log
+
+logger = log.get('tasks')
+
+CHECK_INTERVAL = 1.0 # in seconds, how often a compiled task checks whether its file has changed
+
+
+def parse_task(tmpl: Template) -> Tuple[str, str, str, str, str]: # returns [title, text, task_template, lang, source_code]
+    # NOTE: this function is intentially NOT good, it will be replaced with mongodb I guess
+    full_text = tmpl.render(None).strip(" \n\t")
+
+    if full_text.startswith("<!--"):
+        full_text = full_text[len("<!--"):].strip("\n")
+
+    i1 = full_text.find("-->")
+    if i1 == -1:
+        raise RuntimeError("couldn't find enclosing tag '-->' for params in the template text")
+
+    params_text = full_text[:i1-1]
+    params = eval(params_text)
+
+    full_text = full_text[i1+len("-->"):]
+    full_text = full_text.strip(" \n")
+
+    i2 = full_text.find("<!--")
+    if i2 == -1:
+        raise RuntimeError("couldn't find opening tag '<!--' for code in the template text")
+    code = full_text[i2+len("<!--"):]
+    if code.endswith("-->"):
+        code = code[:len(code)-len("-->")].strip("\n")
+
+    text = full_text[:i2-1]
+    return params["title"], text, params["build_env"], params["lang"], code
+
+
+class TaskNotFound(Exception):
+    pass
+
+
+class CompiledTask:
+    # a task rendered once into a ready to send response body
+    def __init__(self, task_id: str, title: str, lang: str, build_env: str, body: bytes, etag: Optional[str] = None,
+                 path: Optional[str] = None, mtime: Optional[float] = None, text: str = '', code: str = ''):
+        self.task_id = task_id
+        self.title = title
+        self.lang = lang
+        self.build_env = build_env
+        self.body = body
+        self.etag = etag or '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        self.path = path # the template file, only for tasks compiled from files
+        self.mtime = mtime
+        self.text = text
+        self.code = code
+        self.checked_at = time.time()
+
+    def short(self) -> dict:
+        return {'task_id': self.task_id, 'title': self.title, 'lang': self.lang, 'build_env': self.build_env}
+
+
+def compile_file(task_id: str) -> CompiledTask:
+    try:
+        tmpl = loader.get_template('tasks/' + task_id + '.html')
+    except TemplateDoesNotExist:
+        raise TaskNotFound(task_id)
+    mtime = os.stat(tmpl.origin.name).st_mtime
+
+    title, text, build_env, lang, source_code = parse_task(tmpl)
+    resp = {
+        "title": title,
+        "text": base64.b64encode(text.encode('utf-8')).decode('ascii'),
+        "build_env": build_env,
+        "lang": lang,
+        "code": [
+            {
+                "file": "src0",
+                "text": base64.b64encode(source_code.encode('utf-8')).decode('ascii'),
+            },
+        ],
+    }
+    body = json.dumps(resp, escape_forward_slashes=False).encode('utf-8')
+    return CompiledTask(task_id, title, lang, build_env, body, path=tmpl.origin.name, mtime=mtime, text=text, code=source_code)
+
+
+def from_row(row) -> CompiledTask:
+    return CompiledTask(row.task_id, row.title, row.lang, row.build_env, bytes(row.body), row.etag)
+
+
+class TaskCatalog:
+    def __init__(self):
+        self.tasks: Dict[str, CompiledTask] = {}
+
+    def use_db(self) -> bool:
+        return settings.TASK_STORE == 'db'
+
+    def compile(self, task_id: str) -> CompiledTask:
+        if self.use_db():
+            row = task_store.get_task(task_id)
+            if row is None:
+                raise TaskNotFound(task_id)
+            return from_row(row)
+        return compile_file(task_id)
+
+    def is_fresh(self, task: CompiledTask) -> bool:
+        if self.use_db():
+            return task_store.task_etag(task.task_id) == task.etag
+        try:
+            return os.stat(task.path).st_mtime == task.mtime
+        except FileNotFoundError:
+            return False
+
+    def get(self, task_id: str) -> CompiledTask:
+        # raises TaskNotFound for unknown tasks
+        task = self.tasks.get(task_id)
+        if task is not None:
+            t = time.time()
+            if t - task.checked_at < CHECK_INTERVAL:
+                return task
+            task.checked_at = t
+            if self.is_fresh(task):
+                return task
+
+        task = self.compile(task_id)
+        self.tasks[task_id] = task
+        return task
+
+    def preload(self) -> int:
+        # compile every task in advance, so the first requests don't pay for it
+        if self.use_db():
+            for row in task_store.all_tasks():
+                self.tasks[row.task_id] = from_row(row)
+            return len(self.tasks)
+
+        tasks_dir = os.path.join(settings.BASE_DIR, 'practicode_backend', 'templates', 'tasks')
+        count = 0
+        for file_name in sorted(os.listdir(tasks_dir)):
+            if file_name.endswith('.html'):
+                task_id = file_name[:-len('.html')]
+                try:
+                    self.get(task_id)
+                except Exception:
+                    # a broken task fails only its own requests, get() raises for it again
+                    logger.exception('couldn\'t compile a task, skipping it', extra=log.fields(task_id=task_id))
+                    continue
+                count += 1
+        return count
+
+    def preload_at_startup(self) -> int:
+        # uvicorn imports the application with its event loop running, and Django doesn't let the ORM
+        # run in such a thread, so the tasks are read in another one, which startup waits for
+        def preload():
+            try:
+                return self.preload()
+            finally:
+                connections.close_all() # the connection belongs to the thread
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(preload).result()
+
+    def list(self, lang: Optional[str] = None, build_env: Optional[str] = None) -> List[dict]:
+        if self.use_db():
+            return task_store.list_tasks(lang, build_env)
+        # without a database there is no index, it's only for development
+        self.preload()
+        return [t.short() for _, t in sorted(self.tasks.items())
+                if (not lang or t.lang == lang) and (not build_env or t.build_env == build_env)]
+
+
+instance = TaskCatalog()
+
+def catalog():
+    return instance
@@ -0,0 +1,73 @@
+# Tasks and test suites compiled into the configured database (see settings.TASK_STORE).
+# Rows are written by `manage.py import_tasks` and read by the task catalog and the test suites cache,
+# every lookup is by a primary key or an index, the filesystem isn't touched.
+import os
+from typing import List, Optional, Tuple
+from . import models
+
+
+def import_from_files(tasks_dir: str) -> Tuple[int, int]:
+    # compile every templates/tasks/*.html and *.tests.json into the tables, returns numbers of imported tasks and suites
+    from . import task_catalog, test_cases
+
+    n_tasks, n_suites = 0, 0
+    for file_name in sorted(os.listdir(tasks_dir)):
+        path = os.path.join(tasks_dir, file_name)
+        if file_name.endswith('.tests.json'):
+            with open(path) as f:
+                text = f.read()
+            suite = test_cases.TestSuite(path, os.stat(path).st_mtime, text)
+            models.TestSuite.objects.update_or_create(suite_id=file_name[:-len('.tests.json')], defaults={
+                'text': text,
+                'version': suite.version,
+            })
+            n_suites += 1
+        elif file_name.endswith('.html'):
+            task_id = file_name[:-len('.html')]
+            task = task_catalog.compile_file(task_id)
+            models.Task.objects.update_or_create(task_id=task_id, defaults={
+                'title': task.title,
+                'lang': task.lang,
+                'build_env': task.build_env,
+                'text': task.text,
+                'code': task.code,
+                'body': task.body,
+                'etag': task.etag,
+            })
+            n_tasks += 1
+    return n_tasks, n_suites
+
+
+def get_task(task_id: str) -> Optional[models.Task]:
+    return models.Task.objects.filter(task_id=task_id).only('task_id', 'title', 'lang', 'build_env', 'body', 'etag').first()
+
+
+def task_etag(task_id: str) -> Optional[str]:
+    return models.Task.objects.filter(task_id=task_id).values_list('etag', flat=True).first()
+
+
+def all_tasks() -> List[models.Task]:
+    return list(models.Task.objects.only('task_id', 'title', 'lang', 'build_env', 'body', 'etag'))
+
+
+def list_tasks(lang: Optional[str] = None, build_env: Optional[str] = None) -> List[dict]:
+    tasks = models.Task.objects.all()
+    if lang:
+        tasks = tasks.filter(lang=lang)
+    if build_env:
+        tasks = tasks.filter(build_env=build_env)
+    return list(tasks.order_by('task_id').values('task_id', 'title', 'lang', 'build_env'))
+
+
+def test_suite_version(task_id: str) -> Optional[Tuple[str, str]]:
+    # returns (suite_id, version) of the task's own suite or of the default one
+    rows = models.TestSuite.objects.filter(suite_id__in=(task_id, 'default')).values_list('suite_id', 'version')
+    versions = dict(rows)
+    for suite_id in (task_id, 'default'):
+        if suite_id in versions:
+            return suite_id, versions[suite_id]
+    return None
+
+
+def get_test_suite(suite_id: str) -> models.TestSuite:
+    return models.TestSuite.objects.get(suite_id=suite_id)
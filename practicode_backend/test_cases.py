@@ -1,11 +1,100 @@
+from django.conf import settings
+import asyncio
+import collections
+import hashlib
+import os
+import time
+import ujson as json
+from typing import Dict
+from . import log
 
-def load_for(task_id: str):
-    # load a test suite file, NOTE: TEMP KOSTYL, WILL BE REPLACED WITH A DATABASE
-    print(f'looking for practicode_backend/templates/tasks/{task_id}.tests.json')
-    try:
-        with open(f'practicode_backend/templates/tasks/{task_id}.tests.json') as f:
-            test_cases_str = f.read()
-    except FileNotFoundError as e:
-        with open(f'practicode_backend/templates/tasks/default.tests.json') as f:
-            test_cases_str = f.read()
-    return test_cases_str
+logger = log.get('test_cases')
+
+# NOTE: TEMP KOSTYL, WILL BE REPLACED WITH A DATABASE
+TESTS_DIR = 'practicode_backend/templates/tasks'
+DEFAULT_SUITE_PATH = os.path.join(TESTS_DIR, 'default.tests.json')
+CHECK_INTERVAL = 1.0 # in seconds, how often a cached suite checks whether its file has changed
+MAX_CACHED_TASKS = 1000 # task ids come from clients, the least recently used are forgotten
+
+
+class TestSuite:
+    # a test suite kept pre-serialized, only the request id is spliced in for every run
+    def __init__(self, path: str, mtime: float, text: str):
+        if not isinstance(json.loads(text), dict):
+            raise ValueError(f'test suite {path} is not a JSON object')
+        self.path = path
+        self.mtime = mtime
+        self.version = hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+        self.tail = text.strip()[1:].lstrip() # everything after the opening brace
+        self.checked_at = time.time()
+
+    def message_for(self, request_id: str) -> str:
+        head = '{"request_id":' + json.dumps(request_id)
+        return head + ('}' if self.tail == '}' else ',' + self.tail)
+
+
+class TestSuitesCache:
+    def __init__(self):
+        # by task_id, a task without its own suite maps to the default one
+        self.suites: collections.OrderedDict = collections.OrderedDict()
+        self.by_path: Dict[str, TestSuite] = {} # every suite is loaded once however many task ids map to it
+        self.loading: Dict[str, asyncio.Future] = {}
+
+    async def get(self, task_id: str) -> TestSuite:
+        suite = self.suites.get(task_id)
+        if suite is not None and time.time() - suite.checked_at < CHECK_INTERVAL:
+            self.suites.move_to_end(task_id)
+            return suite
+
+        # the disk is touched from a thread, and only once for concurrent runs of the same task
+        future = self.loading.get(task_id)
+        if future is None:
+            future = asyncio.get_event_loop().run_in_executor(None, self.load, task_id)
+            self.loading[task_id] = future
+            try:
+                suite = await future
+            finally:
+                del self.loading[task_id]
+            suite.checked_at = time.time()
+            self.by_path[suite.path] = suite
+            self.suites[task_id] = suite
+            self.suites.move_to_end(task_id)
+            if len(self.suites) > MAX_CACHED_TASKS:
+                self.suites.popitem(last=False)
+            return suite
+        return await asyncio.shield(future)
+
+    def load(self, task_id: str) -> TestSuite:
+        if settings.TASK_STORE == 'db':
+            return self.load_from_db(task_id)
+        for path in (os.path.join(TESTS_DIR, f'{task_id}.tests.json'), DEFAULT_SUITE_PATH):
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            cached = self.by_path.get(path)
+            if cached is not None and cached.mtime == mtime:
+                return cached
+            logger.info('loading test suite', extra=log.fields(path=path))
+            with open(path) as f:
+                return TestSuite(path, mtime, f.read())
+        raise FileNotFoundError(f'no test suite for {task_id} and no default one')
+
+    def load_from_db(self, task_id: str) -> TestSuite:
+        from . import task_store
+        found = task_store.test_suite_version(task_id)
+        if found is None:
+            raise FileNotFoundError(f'no test suite for {task_id} and no default one')
+        suite_id, version = found
+        path = f'db:{suite_id}'
+        cached = self.by_path.get(path)
+        if cached is not None and cached.version == version:
+            return cached
+        row = task_store.get_test_suite(suite_id)
+        return TestSuite(path, 0, row.text)
+
+
+cache = TestSuitesCache()
+
+async def load_for(task_id: str) -> TestSuite:
+    return await cache.get(task_id)
@@ -0,0 +1,109 @@
+# Traces of /run requests: when each stage of a run happened and how long messages waited in the bridge.
+#
+# Every run is traced while it's in flight, it's cheap: a timestamp per stage and per queued message.
+# When the run closes, its trace is kept in a ring buffer if the run was slower than TRACE_SLOW_SECONDS,
+# or with a TRACE_SAMPLE probability otherwise. The buffer is served by GET /debug/traces, with the DEBUG_TOKEN.
+import collections
+import os
+import random
+import time
+from typing import Deque, Dict, List, Optional
+
+BUFFER_SIZE = int(os.getenv('TRACE_BUFFER', '1000')) # 0 turns tracing off
+SLOW_SECONDS = float(os.getenv('TRACE_SLOW_SECONDS', '5.0'))
+SAMPLE = float(os.getenv('TRACE_SAMPLE', '0.01')) # share of the other runs that is kept
+
+
+class QueueTimes:
+    # how long messages stay in one queue of a bridge, messages leave a queue in the order they enter it
+    def __init__(self):
+        self.entered: Deque[float] = collections.deque()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.first_left: Optional[float] = None
+
+    def enter(self):
+        self.entered.append(time.time())
+
+    def leave(self):
+        if not self.entered:
+            return # the message entered before the queue was traced
+        now = time.time()
+        waited = now - self.entered.popleft()
+        self.count += 1
+        self.total += waited
+        if waited > self.max:
+            self.max = waited
+        if self.first_left is None:
+            self.first_left = now
+
+    def to_dict(self, start: float) -> dict:
+        return {
+            'messages': self.count,
+            'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+            'max_ms': self.max * 1000,
+            'first_left_ms': (self.first_left - start) * 1000 if self.first_left is not None else None,
+            'still_queued': len(self.entered),
+        }
+
+
+class Trace:
+    def __init__(self, request_id: str, **fields):
+        self.request_id = request_id
+        self.fields = fields
+        self.start = time.time()
+        self.stages: Dict[str, float] = {'accepted': self.start}
+        self.to_worker = QueueTimes()
+        self.to_client = QueueTimes()
+        self.outcome = 'unknown'
+
+    def mark(self, stage: str, at: Optional[float] = None):
+        # only the first time of a stage counts
+        if stage not in self.stages:
+            self.stages[stage] = at if at is not None else time.time()
+
+    def duration(self) -> float:
+        return self.stages.get('closed', time.time()) - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            'request_id': self.request_id,
+            **self.fields,
+            'outcome': self.outcome,
+            'start': self.start,
+            'duration_ms': self.duration() * 1000,
+            'stages_ms': {stage: (at - self.start) * 1000 for stage, at in sorted(self.stages.items(), key=lambda s: s[1])},
+            'bridge': {
+                'to_worker': self.to_worker.to_dict(self.start),
+                'to_client': self.to_client.to_dict(self.start),
+            },
+        }
+
+
+class Tracer:
+    def __init__(self, size: int):
+        self.traces: Deque[Trace] = collections.deque(maxlen=size)
+
+    def enabled(self) -> bool:
+        return self.traces.maxlen > 0
+
+    def start(self, request_id: str, **fields) -> Trace:
+        return Trace(request_id, **fields)
+
+    def finish(self, trace: Trace, outcome: str):
+        trace.outcome = outcome
+        trace.mark('closed')
+        if self.enabled() and (trace.duration() >= SLOW_SECONDS or random.random() < SAMPLE):
+            self.traces.append(trace)
+
+    def list(self, request_id: Optional[str] = None, min_duration: float = 0.0) -> List[dict]:
+        # the latest first
+        return [t.to_dict() for t in reversed(self.traces)
+                if (request_id is None or t.request_id == request_id) and t.duration() >= min_duration]
+
+
+instance = Tracer(BUFFER_SIZE)
+
+def tracer():
+    return instance
@@ -21,8 +21,12 @@ from . import handle_run
 
 urlpatterns = [
     path('admin', admin.site.urls),
+    path('tasks', views.list_tasks, name='list_tasks'),
     path('tasks/<str:task_id>', views.get_task, name='get_task'),
     path('runner', views.runner, name='runner'),
+    path('metrics', views.get_metrics, name='metrics'),
+    path('debug/traces', views.list_traces, name='list_traces'),
+    path('debug/bridges', views.list_bridges, name='list_bridges'),
 
     path('bridge', handle_bridge.handle, name='bridge'),
     path('run', handle_run.handle, name='run'),
@@ -1,59 +1,73 @@
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseNotModified
 from django.http import JsonResponse
-from django.template import loader, Template
+import functools
+import hmac
 import os
-from typing import Tuple
-import pybase64 as base64
+from . import client_id
+from . import metrics
+from . import task_catalog
+from . import tracing
+from . import workers
 
 
-def parse_task(tmpl: Template) -> Tuple[str, str, str, str, str]: # returns [title, text, task_template, lang, source_code]
-    # NOTE: this function is intentially NOT good, it will be replaced with mongodb I guess
-    full_text = tmpl.render(None).strip(" \n\t")
+def get_task(request, task_id):
+    try:
+        task = task_catalog.catalog().get(task_id)
+    except task_catalog.TaskNotFound:
+        raise Http404(f'No task {task_id}')
 
-    if full_text.startswith("<!--"):
-        full_text = full_text[len("<!--"):].strip("\n")
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None and task.etag in (etag.strip() for etag in if_none_match.split(',')):
+        resp = HttpResponseNotModified()
+    else:
+        resp = HttpResponse(task.body, content_type='application/json')
+    resp['ETag'] = task.etag
+    client_id.issue(request, resp)
+    return resp
 
-    i1 = full_text.find("-->")
-    if i1 == -1:
-        raise RuntimeError("couldn't find enclosing tag '-->' for params in the template text")
 
-    params_text = full_text[:i1-1]
-    params = eval(params_text)
+def list_tasks(request):
+    tasks = task_catalog.catalog().list(request.GET.get('lang'), request.GET.get('build_env'))
+    return JsonResponse({'tasks': tasks})
 
-    full_text = full_text[i1+len("-->"):]
-    full_text = full_text.strip(" \n")
 
-    i2 = full_text.find("<!--")
-    if i2 == -1:
-        raise RuntimeError("couldn't find opening tag '<!--' for code in the template text")
-    code = full_text[i2+len("<!--"):]
-    if code.endswith("-->"):
-        code = code[:len(code)-len("-->")].strip("\n")
+def get_metrics(request):
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
 
-    text = full_text[:i2-1]
-    return params["title"], text, params["build_env"], params["lang"], code
 
+def debug_only(view):
+    # the debug endpoints show request ids, which are enough to resume somebody else's run
+    @functools.wraps(view)
+    def checked(request, *args, **kwargs):
+        if not settings.DEBUG_TOKEN:
+            raise Http404('Debug endpoints are off')
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {settings.DEBUG_TOKEN}'):
+            return JsonResponse({'description': 'A debug token is needed'}, status=403)
+        return view(request, *args, **kwargs)
+    return checked
 
-def get_task(request, task_id):
-    tmpl = loader.get_template('tasks/' + task_id + '.html')
-
-    title, text, build_env, lang, source_code = parse_task(tmpl)
-    resp = {
-        "title": title,
-        "text": base64.b64encode(text.encode('utf-8')).decode('ascii'),
-        "build_env": build_env,
-        "lang": lang,
-        "code": [
-            {
-                "file": "src0",
-                "text": base64.b64encode(source_code.encode('utf-8')).decode('ascii'),
-            },
-        ],
-    }
-    return JsonResponse(resp)
+
+@debug_only
+def list_traces(request):
+    # kept traces of /run requests, the latest first, ?request_id= and ?min_ms= filter them
+    min_ms = request.GET.get('min_ms', '0')
+    try:
+        min_duration = float(min_ms) / 1000
+    except ValueError:
+        return JsonResponse({'description': f'Invalid min_ms: {min_ms}'}, status=400)
+    return JsonResponse({'traces': tracing.tracer().list(request.GET.get('request_id'), min_duration)})
+
+
+@debug_only
+def list_bridges(request):
+    # queued messages and bytes of every bridge, the memory /metrics only has totals of
+    return JsonResponse({'bridges': workers.manager().bridges_stats()})
 
 
 def runner(request):
-    return JsonResponse({
+    resp = JsonResponse({
         'RUNNER_WEBSOCKET_URL': 'ws://' + os.getenv('RUNNER_HOST', 'localhost:8000') + '/run',
     })
+    client_id.issue(request, resp)
+    return resp
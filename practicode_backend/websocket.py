@@ -1,7 +1,7 @@
-import json
 import typing
 from urllib import parse
-import asyncio
+
+import ujson as json
 
 
 class State:
@@ -48,53 +48,76 @@ class ReceiveEvent:
 
 
 class Headers:
+    # the headers of a connection, decoded on the first lookup, names are lowercase in ASGI
+    __slots__ = ("_scope", "_dict")
+
     def __init__(self, scope):
         self._scope = scope
+        self._dict = None
 
     def keys(self):
-        return [header[0].decode() for header in self._scope["headers"]]
+        return self.as_dict().keys()
 
     def as_dict(self) -> dict:
-        return {h[0].decode(): h[1].decode() for h in self._scope["headers"]}
+        if self._dict is None:
+            self._dict = {h[0].decode("latin-1"): h[1].decode("latin-1") for h in self._scope["headers"]}
+        return self._dict
 
-    def get(self, item, default=None):
-        return self.as_dict().get(item, default)
+    def get(self, item: str, default=None):
+        return self.as_dict().get(item.lower(), default)
 
     def __getitem__(self, item: str) -> str:
         return self.as_dict()[item.lower()]
 
     def __repr__(self) -> str:
-        return str(dict(self))
+        return str(self.as_dict())
 
 
 class QueryParams:
+    # the query parameters of a connection, parsed on the first lookup
+    __slots__ = ("_query_string", "_dict")
+
     def __init__(self, query_string: str):
-        self._dict = dict(parse.parse_qsl(query_string))
+        self._query_string = query_string
+        self._dict = None
+
+    def as_dict(self) -> dict:
+        if self._dict is None:
+            self._dict = dict(parse.parse_qsl(self._query_string))
+        return self._dict
 
     def keys(self):
-        return self._dict.keys()
+        return self.as_dict().keys()
 
     def get(self, item, default=None):
-        return self._dict.get(item, default)
+        return self.as_dict().get(item, default)
 
     def __getitem__(self, item: str):
-        return self._dict[item]
+        return self.as_dict()[item]
 
     def __repr__(self) -> str:
-        return str(dict(self))
+        return str(self.as_dict())
 
 
 class WebSocket:
+    # one per connection, so it's lean: the scope is parsed once and only if asked, and sending or receiving
+    # a message of a connected socket costs a state comparison on top of the ASGI call
+    __slots__ = ("_scope", "_receive", "_send", "_client_state", "_app_state", "_headers", "_query_params")
+
     def __init__(self, scope, receive, send):
         self._scope = scope
         self._receive = receive
         self._send = send
         self._client_state = State.CONNECTING
         self._app_state = State.CONNECTING
+        self._headers = None
+        self._query_params = None
 
     @property
-    def headers(self):
-        return Headers(self._scope)
+    def headers(self) -> Headers:
+        if self._headers is None:
+            self._headers = Headers(self._scope)
+        return self._headers
 
     @property
     def scheme(self):
@@ -105,8 +128,10 @@ class WebSocket:
         return self._scope["path"]
 
     @property
-    def query_params(self):
-        return QueryParams(self._scope["query_string"].decode())
+    def query_params(self) -> QueryParams:
+        if self._query_params is None:
+            self._query_params = QueryParams(self._scope["query_string"].decode("latin-1"))
+        return self._query_params
 
     @property
     def query_string(self) -> str:
@@ -133,64 +158,55 @@ class WebSocket:
         await self.send({"type": SendEvent.CLOSE, "code": code})
 
     async def send(self, message: typing.Mapping):
-        if self._app_state == State.DISCONNECTED:
-            raise RuntimeError("WebSocket is disconnected.")
+        message_type = message["type"]
+        if self._app_state == State.CONNECTED:
+            if message_type == SendEvent.CLOSE:
+                self._app_state = State.DISCONNECTED
+            elif message_type != SendEvent.SEND:
+                raise RuntimeError('Connected socket can send "%s" and "%s" events, not "%s"'
+                                   % (SendEvent.SEND, SendEvent.CLOSE, message_type))
 
-        if self._app_state == State.CONNECTING:
-            assert message["type"] in {SendEvent.ACCEPT, SendEvent.CLOSE}, (
-                'Could not write event "%s" into socket in connecting state.'
-                % message["type"]
-            )
-            if message["type"] == SendEvent.CLOSE:
+        elif self._app_state == State.CONNECTING:
+            if message_type == SendEvent.ACCEPT:
+                self._app_state = State.CONNECTED
+            elif message_type == SendEvent.CLOSE:
                 self._app_state = State.DISCONNECTED
             else:
-                self._app_state = State.CONNECTED
+                raise RuntimeError('Could not write event "%s" into socket in connecting state.' % message_type)
 
-        elif self._app_state == State.CONNECTED:
-            assert message["type"] in {SendEvent.SEND, SendEvent.CLOSE}, (
-                'Connected socket can send "%s" and "%s" events, not "%s"'
-                % (SendEvent.SEND, SendEvent.CLOSE, message["type"])
-            )
-            if message["type"] == SendEvent.CLOSE:
-                self._app_state = State.DISCONNECTED
+        else:
+            raise RuntimeError("WebSocket is disconnected.")
 
         await self._send(message)
 
     async def receive(self):
+        if self._client_state == State.CONNECTED:
+            message = await self._receive()
+            if message["type"] != ReceiveEvent.RECEIVE:
+                self._not_received(message)
+            return message
+
         if self._client_state == State.DISCONNECTED:
             raise RuntimeError("WebSocket is disconnected.")
 
         message = await self._receive()
-
-        if self._client_state == State.CONNECTING:
-            assert message["type"] == ReceiveEvent.CONNECT, (
-                'WebSocket is in connecting state but received "%s" event'
-                % message["type"]
-            )
-            self._client_state = State.CONNECTED
-
-        elif self._client_state == State.CONNECTED:
-            assert message["type"] in {ReceiveEvent.RECEIVE, ReceiveEvent.DISCONNECT}, (
-                'WebSocket is connected but received invalid event "%s".'
-                % message["type"]
-            )
-            if message["type"] == ReceiveEvent.DISCONNECT:
-                self._client_state = State.DISCONNECTED
-                raise DisconnectError()
-
+        if message["type"] != ReceiveEvent.CONNECT:
+            raise RuntimeError('WebSocket is in connecting state but received "%s" event' % message["type"])
+        self._client_state = State.CONNECTED
         return message
 
     async def receive_json(self) -> typing.Any:
-        message = await self.receive()
-        self._test_if_can_receive(message)
-        return json.loads(message["text"])
+        return json.loads(await self.receive_text())
 
     async def receive_jsonb(self) -> typing.Any:
-        message = await self.receive()
-        self._test_if_can_receive(message)
-        return json.loads(message["bytes"].decode())
+        return json.loads(await self.receive_bytes())
 
     async def receive_text(self) -> str:
+        if self._client_state == State.CONNECTED:
+            message = await self._receive()
+            if message["type"] != ReceiveEvent.RECEIVE:
+                self._not_received(message)
+            return message["text"]
         message = await self.receive()
         self._test_if_can_receive(message)
         return message["text"]
@@ -201,22 +217,33 @@ class WebSocket:
         return message["bytes"]
 
     async def send_json(self, data: typing.Any, **dump_kwargs):
-        data = json.dumps(data, **dump_kwargs)
-        await self.send({"type": SendEvent.SEND, "text": data})
+        await self.send_text(json.dumps(data, escape_forward_slashes=False, **dump_kwargs))
 
     async def send_jsonb(self, data: typing.Any, **dump_kwargs):
-        data = json.dumps(data, **dump_kwargs)
-        await self.send({"type": SendEvent.SEND, "bytes": data.encode()})
+        await self.send_bytes(json.dumps(data, escape_forward_slashes=False, **dump_kwargs).encode())
 
     async def send_text(self, text: str):
-        await self.send({"type": SendEvent.SEND, "text": text})
+        """Send an already encoded frame, e.g. a worker's output as it came.
+        Only a connected socket can send, the rest of the states are checked by send().
+        """
+        if self._app_state != State.CONNECTED:
+            return await self.send({"type": SendEvent.SEND, "text": text})
+        await self._send({"type": SendEvent.SEND, "text": text})
 
     async def send_bytes(self, text: typing.Union[str, bytes]):
         if isinstance(text, str):
             text = text.encode()
-        await self.send({"type": SendEvent.SEND, "bytes": text})
+        if self._app_state != State.CONNECTED:
+            return await self.send({"type": SendEvent.SEND, "bytes": text})
+        await self._send({"type": SendEvent.SEND, "bytes": text})
+
+    def _not_received(self, message: typing.Mapping):
+        # a connected socket has got something other than a data message
+        if message["type"] == ReceiveEvent.DISCONNECT:
+            self._client_state = State.DISCONNECTED
+            raise DisconnectError()
+        raise RuntimeError('WebSocket is connected but received invalid event "%s".' % message["type"])
 
     def _test_if_can_receive(self, message: typing.Mapping):
-        assert message["type"] in (ReceiveEvent.RECEIVE, ReceiveEvent.DISCONNECT), (
-            'Invalid message type "%s". Was connection accepted?' % message["type"]
-        )
+        if message["type"] != ReceiveEvent.RECEIVE:
+            raise RuntimeError('Invalid message type "%s". Was connection accepted?' % message["type"])
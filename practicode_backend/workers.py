@@ -1,14 +1,93 @@
 import asyncio
+import collections
+import heapq
+import itertools
+import os
 import ujson as json
-import random
-from typing import List, Dict
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from . import envelope
+from . import log
+from . import metrics
+
+logger = log.get('workers')
+
+# bounds of each direction of a bridge, sizes are counted in characters of the queued messages
+MAX_QUEUED_MESSAGES = int(os.getenv('BRIDGE_MAX_QUEUED_MESSAGES', '1000'))
+MAX_QUEUED_BYTES = int(os.getenv('BRIDGE_MAX_QUEUED_BYTES', str(8 * 1024 * 1024)))
+# a worker with flow control is asked to pause a request's output when the queue to the client is that full, and to resume when it's drained
+PAUSE_WORKER_AT = 0.5
+RESUME_WORKER_AT = 0.25
+TRUNCATION_NOTICE = 'Output is too large, a part of it has been truncated'
+# in seconds, how long a worker has to confirm a cancelled run with its `finish` before its slot is counted as free anyway
+CANCEL_TIMEOUT = float(os.getenv('BRIDGE_CANCEL_TIMEOUT', '30'))
+# priority classes of requests in the wait queue, lower goes first
+PRIORITIES = {'exam': 0, 'teacher': 1, 'student': 2}
+DEFAULT_PRIORITY = PRIORITIES['student']
+# in seconds, requests that are that close to their deadline are given a worker before the others
+URGENT_WINDOW = float(os.getenv('SCHEDULER_URGENT_WINDOW', '10'))
+POSITION_UPDATE_INTERVAL = 1.0 # in seconds, positions in the queues are published at most that often
+POSITION_GRANULARITY = 20 # a waiter is told about a change of its position by 1/20 of it, or any change in the first 20
+NOTIFY_CHUNK = 200 # waiters woken per loop iteration when positions are published, so a long queue doesn't stall the loop
+# in seconds, a request whose estimated wait for a worker is longer is rejected right away, 0 turns it off
+MAX_ESTIMATED_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', '120'))
+MIN_RETRY_AFTER = 5.0 # in seconds
+RUN_DURATION_SMOOTHING = 0.1 # weight of the latest run in the average run duration of a build_env
+# in seconds, how long the head of a queue may wait for a worker that has recently run its task while other workers are free,
+# and how long a free worker may wait for a request whose task it has recently run
+AFFINITY_WAIT = float(os.getenv('SCHEDULER_AFFINITY_WAIT', '0.5'))
+AFFINITY_WORKERS = 8 # workers remembered per task, the latest ones
+AFFINITY_TASKS = 10000 # tasks remembered, the latest ones
+WORKER_TASKS = 16 # tasks remembered per worker, the latest ones
+OTHER_BUILD_ENV = 'other' # the metrics label of the build_envs /run clients ask for that no worker has registered with
+
+REJECTED = metrics.counter('practicode_rejected_requests_total', 'Requests rejected because the estimated wait was too long', ('build_env',))
+AFFINITY_DISPATCHES = metrics.counter('practicode_affinity_dispatches_total', 'Requests given a worker, by whether it has recently run their task',
+                                      ('build_env', 'result'))
+QUEUE_WAIT = metrics.histogram('practicode_queue_wait_seconds', 'Time from queueing a request to giving it a worker', ('build_env',))
+RUN_DURATION = metrics.histogram('practicode_run_duration_seconds', 'Time a request holds a worker', ('build_env',))
+RELAYED_MESSAGES = metrics.counter('practicode_relayed_messages_total', 'Messages put into bridges', ('direction',))
+RELAYED_BYTES = metrics.counter('practicode_relayed_bytes_total', 'Characters of messages put into bridges', ('direction',))
+CANCELLED_RUNS = metrics.counter('practicode_cancelled_runs_total', 'Runs whose worker was told to stop, by whether it confirmed', ('result',))
+DROPPED_MESSAGES = metrics.counter('practicode_dropped_messages_total', 'Output dropped because a client didn\'t keep up')
+WORKER_DISCONNECTS = metrics.counter('practicode_worker_disconnects_total', 'Workers that have disconnected', ('build_env',))
+WORKERS = metrics.gauge('practicode_workers', 'Connected workers', ('build_env',))
+WORKER_SLOTS = metrics.gauge('practicode_worker_slots', 'Requests connected workers can run at once', ('build_env',))
+BUSY_SLOTS = metrics.gauge('practicode_worker_busy_slots', 'Requests connected workers are running', ('build_env',))
+UTILISATION = metrics.gauge('practicode_worker_utilisation', 'Busy slots divided by slots', ('build_env',))
+QUEUE_DEPTH = metrics.gauge('practicode_queue_depth', 'Requests waiting for a worker', ('build_env',))
+BRIDGES = metrics.gauge('practicode_bridges', 'Requests bridged to a worker')
+BRIDGE_QUEUED_MESSAGES = metrics.gauge('practicode_bridge_queued_messages', 'Messages waiting in bridges', ('direction',))
+BRIDGE_QUEUED_BYTES = metrics.gauge('practicode_bridge_queued_bytes', 'Characters of messages waiting in bridges', ('direction',))
+# resolved once, they're updated for every relayed message
+TO_WORKER_MESSAGES = RELAYED_MESSAGES.labels('to_worker')
+TO_WORKER_BYTES = RELAYED_BYTES.labels('to_worker')
+TO_CLIENT_MESSAGES = RELAYED_MESSAGES.labels('to_client')
+TO_CLIENT_BYTES = RELAYED_BYTES.labels('to_client')
+DROPPED = DROPPED_MESSAGES.labels()
 
 
 class Worker:
-    def __init__(self, worker_id: str, build_env: str):
+    def __init__(self, worker_id: str, build_env: str, slots: int = 1, flow_control: bool = False):
         self.worker_id = worker_id
         self.build_env = build_env
+        self.slots = slots # how many requests the worker runs at once
+        self.flow_control = flow_control # whether the worker understands pause/resume commands
         self.busy_factor = 0
+        self.pool_entry = None # the valid entry of the worker in WorkerPool's heap
+        self.bridges: Dict[str, Bridge] = {} # by request_id
+        # bridges that have messages for this worker, served round-robin by receive_for_worker
+        self.pending_bridges = collections.deque()
+        self.has_pending = asyncio.Event()
+        self.warm_tasks = collections.OrderedDict() # Ticket.affinity of the requests it has recently run, the least recent first
+        self.free_since = time.time() # when it was last given a request or a slot of it was freed
+
+    def schedule(self, bridge):
+        # wake up the worker's receive loop, a bridge is queued once no matter how many messages it has
+        if not bridge.scheduled:
+            bridge.scheduled = True
+            self.pending_bridges.append(bridge)
+            self.has_pending.set()
 
     def inc_busy_factor(self):
         self.busy_factor += 1
@@ -18,40 +97,256 @@ class Worker:
         assert(self.busy_factor >= 0)
 
     def available(self):
-        return self.busy_factor == 0
+        return self.busy_factor < self.slots
+
+    def load(self) -> float:
+        return self.busy_factor / self.slots
+
+
+class WorkerPool:
+    # workers of one build_env that have free slots, the least loaded first, and by the tasks they have recently run;
+    # every operation is O(log n), or O(WORKER_TASKS) for a worker that becomes free or busy
+    def __init__(self):
+        self.free: collections.OrderedDict = collections.OrderedDict() # worker_id -> Worker, the longest free first
+        self.heap = [] # [load, seq, worker], entries are invalidated lazily when a worker's load changes
+        self.counter = itertools.count()
+        self.warm_free: Dict[str, Dict[str, Worker]] = {} # by Ticket.affinity, free workers that have recently run it
+        self.newly_warm: List[str] = [] # affinities that have got a free warm worker since the last dispatch
+        # (priority, tag, seq, ticket) of queued tickets that a free worker is warm for, the first of every such
+        # affinity is there, taken tickets and affinities that have lost their free workers are dropped lazily
+        self.candidates: List[tuple] = []
+
+    def __len__(self):
+        return len(self.free)
+
+    def update(self, worker: Worker, is_free: bool):
+        if is_free:
+            if worker.worker_id not in self.free:
+                for affinity in worker.warm_tasks:
+                    self._add_warm(worker, affinity)
+            self.free[worker.worker_id] = worker
+            self.free.move_to_end(worker.worker_id) # its free_since has just been set
+            worker.pool_entry = [worker.load(), next(self.counter), worker]
+            heapq.heappush(self.heap, worker.pool_entry)
+            if len(self.heap) > 2 * len(self.free) + 16:
+                # too many stale entries, rebuild the heap from valid ones
+                self.heap = [w.pool_entry for w in self.free.values()]
+                heapq.heapify(self.heap)
+        else:
+            if self.free.pop(worker.worker_id, None) is not None:
+                for affinity in worker.warm_tasks:
+                    self._remove_warm(worker, affinity)
+            worker.pool_entry = None
+
+    def oldest_free_since(self) -> float:
+        return next(iter(self.free.values())).free_since
+
+    def warm_task_added(self, worker: Worker, affinity: str):
+        if worker.worker_id in self.free:
+            self._add_warm(worker, affinity)
+
+    def warm_task_dropped(self, worker: Worker, affinity: str):
+        if worker.worker_id in self.free:
+            self._remove_warm(worker, affinity)
+
+    def _add_warm(self, worker: Worker, affinity: str):
+        workers = self.warm_free.get(affinity)
+        if workers is None:
+            workers = self.warm_free[affinity] = {}
+            self.newly_warm.append(affinity)
+        workers[worker.worker_id] = worker
+
+    def _remove_warm(self, worker: Worker, affinity: str):
+        workers = self.warm_free.get(affinity)
+        if workers is not None:
+            workers.pop(worker.worker_id, None)
+            if not workers:
+                del self.warm_free[affinity]
+
+    def queued(self, ticket: 'Ticket'):
+        if ticket.affinity in self.warm_free:
+            heapq.heappush(self.candidates, (ticket.priority, ticket.tag, ticket.seq, ticket))
+
+    def sync(self, queue: Optional['FairQueue']):
+        # called on every dispatch, the affinities that have got a free warm worker get their candidate
+        if queue is not None:
+            for affinity in self.newly_warm:
+                ticket = queue.first(affinity) if affinity in self.warm_free else None
+                if ticket is not None:
+                    heapq.heappush(self.candidates, (ticket.priority, ticket.tag, ticket.seq, ticket))
+        self.newly_warm.clear()
+        if len(self.candidates) > 2 * (len(queue) if queue is not None else 0) + 16:
+            # too many taken tickets, rebuild from the first ticket of every affinity that has an entry
+            first = (queue.first(affinity) for affinity in {e[-1].affinity for e in self.candidates}
+                     if queue is not None and affinity in self.warm_free)
+            self.candidates = [(t.priority, t.tag, t.seq, t) for t in first if t is not None]
+            heapq.heapify(self.candidates)
+
+    def warm_request(self, queue: 'FairQueue') -> Tuple[Optional['Ticket'], Optional[Worker]]:
+        # the request that goes first among the ones a free worker has recently run the task of
+        self.sync(queue)
+        while self.candidates:
+            ticket = self.candidates[0][-1]
+            workers = self.warm_free.get(ticket.affinity)
+            if ticket.queued and workers:
+                return ticket, next(iter(workers.values()))
+            heapq.heappop(self.candidates)
+            if workers:
+                # taken, the next request of the task goes after it in the queue, so it's its turn to be a candidate
+                successor = queue.first(ticket.affinity)
+                if successor is not None:
+                    heapq.heappush(self.candidates, (successor.priority, successor.tag, successor.seq, successor))
+        return None, None
+
+    def least_loaded(self) -> Optional[Worker]:
+        while self.heap:
+            entry = self.heap[0]
+            worker = entry[2]
+            if worker.pool_entry is entry and worker.worker_id in self.free:
+                return worker
+            heapq.heappop(self.heap)
+        return None
 
 
 class DisconnectError(Exception):
     pass
 
 
+class RejectedError(Exception):
+    # the queue is too long for a request to get a worker in time
+    def __init__(self, retry_after: float):
+        super().__init__(f'the estimated wait is too long, retry after {retry_after:.0f} s')
+        self.retry_after = retry_after
+
+
 class Bridge:
-    def __init__(self, worker: Worker, request_id: str):
+    def __init__(self, worker: Worker, request_id: str, max_messages: int = MAX_QUEUED_MESSAGES, max_bytes: int = MAX_QUEUED_BYTES):
         self.request_id = request_id
         self.worker = worker
+        self.worker_id = worker.worker_id # stays after close, when the worker is detached
+        self.build_env = worker.build_env
+        self.created_at = time.monotonic()
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
         self.msgs_to_worker = asyncio.Queue()
         self.msgs_to_client = asyncio.Queue()
+        self.bytes_to_worker = 0
+        self.bytes_to_client = 0
+        self.room_to_worker = asyncio.Event() # cleared while the queue to the worker is full
+        self.room_to_worker.set()
+        self.worker_paused = False
+        self.truncating = False # dropping output because the client doesn't keep up
+        self.dropped_msgs = 0
         self.worker.inc_busy_factor()
         self.disconnected = False
+        self.scheduled = False
+        self.started = False # whether anything has been sent to the worker
+        self.cancel_timer: Optional[asyncio.TimerHandle] = None # set while the worker is stopping the run
+        self.times_to_worker = None # tracing.QueueTimes, when the run is traced
+        self.times_to_client = None
+
+    def attach_trace(self, trace):
+        self.times_to_worker = trace.to_worker
+        self.times_to_client = trace.to_client
+
+    def _full(self, queue: asyncio.Queue, queued_bytes: int, fraction: float = 1.0) -> bool:
+        return queue.qsize() >= self.max_messages * fraction or queued_bytes >= self.max_bytes * fraction
 
     async def receive_from_worker(self):
         msg = await self.msgs_to_client.get()
-        # if it's a DisconnectError sent from the disconnect method, it means we should stop listening to, worker has disconnected
-        if type(msg) == DisconnectError:
+        # if it's a DisconnectError sent from the disconnect method, it means we should stop listening to, worker has disconnected,
+        # other errors come from interrupt()
+        if isinstance(msg, Exception):
             raise msg
+        self.bytes_to_client -= len(msg)
+        if self.times_to_client is not None:
+            self.times_to_client.leave()
+        if self.worker_paused and not self._full(self.msgs_to_client, self.bytes_to_client, RESUME_WORKER_AT):
+            self.worker_paused = False
+            self.send_to_worker({'request_id': self.request_id, 'command': 'resume'})
         return msg
 
     def send_to_worker(self, msg):
         if type(msg) == dict:
             msg = json.dumps(msg)
+        self.started = True
         self.msgs_to_worker.put_nowait(msg)
+        self.bytes_to_worker += len(msg)
+        TO_WORKER_MESSAGES.inc()
+        TO_WORKER_BYTES.inc(len(msg))
+        if self.times_to_worker is not None:
+            self.times_to_worker.enter()
+        if self._full(self.msgs_to_worker, self.bytes_to_worker):
+            self.room_to_worker.clear()
+        self.worker.schedule(self)
+
+    # called by the worker's receive loop
+    def take_for_worker(self) -> str:
+        msg = self.msgs_to_worker.get_nowait()
+        self.bytes_to_worker -= len(msg)
+        if self.times_to_worker is not None:
+            self.times_to_worker.leave()
+        if not self._full(self.msgs_to_worker, self.bytes_to_worker):
+            self.room_to_worker.set()
+        return msg
+
+    # producers of messages to the worker wait here, so a client that floods the worker isn't read from
+    async def wait_for_room_to_worker(self):
+        await self.room_to_worker.wait()
 
     def send_to_client(self, msg: str):
+        # the worker's socket is shared by several requests, so it can't stop being read, overflowing output is dropped instead
+        if self._full(self.msgs_to_client, self.bytes_to_client) and not envelope.is_finish(msg):
+            if not self.truncating:
+                self.truncating = True
+                self._put_to_client(json.dumps({
+                    'request_id': self.request_id,
+                    'stage': 'backend',
+                    'description': TRUNCATION_NOTICE,
+                }))
+            self.dropped_msgs += 1
+            DROPPED.inc()
+            return
+        self.truncating = False
+        self._put_to_client(msg)
+
+        if self.worker.flow_control and not self.worker_paused and self._full(self.msgs_to_client, self.bytes_to_client, PAUSE_WORKER_AT):
+            self.worker_paused = True
+            self.send_to_worker({'request_id': self.request_id, 'command': 'pause'})
+
+    def _put_to_client(self, msg: str):
         self.msgs_to_client.put_nowait(msg)
+        self.bytes_to_client += len(msg)
+        TO_CLIENT_MESSAGES.inc()
+        TO_CLIENT_BYTES.inc(len(msg))
+        if self.times_to_client is not None:
+            self.times_to_client.enter()
+
+    def queued_bytes(self) -> int:
+        return self.bytes_to_worker + self.bytes_to_client
+
+    def stats(self) -> dict:
+        return {
+            'request_id': self.request_id,
+            'worker_id': self.worker_id,
+            'msgs_to_worker': self.msgs_to_worker.qsize(),
+            'msgs_to_client': self.msgs_to_client.qsize(),
+            'bytes_to_worker': self.bytes_to_worker,
+            'bytes_to_client': self.bytes_to_client,
+            'dropped_msgs': self.dropped_msgs,
+        }
+
+    def discard_to_client(self):
+        # nobody reads the output anymore
+        while not self.msgs_to_client.empty():
+            msg = self.msgs_to_client.get_nowait()
+            if not isinstance(msg, Exception):
+                self.bytes_to_client -= len(msg)
+        self.truncating = False
 
     def close(self):
-        if self.msgs_to_client.qsize() > 0 or self.msgs_to_worker.qsize() > 0:
-            print(f'Warning: a bridge from request_id {self.request_id} to worker {self.worker.worker_id} has pending messages: {self}')
+        if self.bytes_to_client > 0 or self.msgs_to_worker.qsize() > 0: # interrupts left in the queue don't count
+            logger.warning('closing a bridge with pending messages', extra=log.fields(request_id=self.request_id, worker_id=self.worker_id, bridge=self))
         self.worker.dec_busy_factor()
         self.worker = None
     
@@ -59,96 +354,498 @@ class Bridge:
         self.msgs_to_client.put_nowait(DisconnectError())
         self.disconnected = True
 
+    def interrupt(self, error: Exception):
+        # receive_from_worker() raises the error after the queued output, e.g. when the client is gone
+        self.msgs_to_client.put_nowait(error)
+
     def __repr__(self):
-        return f'(request_id: {self.request_id}, worker: {self.worker.worker_id}, msgs_to_client: {self.msgs_to_client.qsize()}, msgs_to_worker: {self.msgs_to_worker.qsize()})'
+        return f'(request_id: {self.request_id}, worker: {self.worker_id}, msgs_to_client: {self.msgs_to_client.qsize()}, msgs_to_worker: {self.msgs_to_worker.qsize()}, queued bytes: {self.queued_bytes()})'
 
 
-class WorkersManager:
+class Ticket:
+    # a request waiting in a queue, `bridge` is resolved by the manager as soon as a worker is given to it
+    def __init__(self, request_id: str, build_env: str, user: str = '', priority: int = DEFAULT_PRIORITY, deadline: Optional[float] = None,
+                 affinity: Optional[str] = None):
+        self.request_id = request_id
+        self.build_env = build_env
+        self.user = user # requests of one user take turns with the requests of the others
+        self.priority = priority # lower goes first
+        self.deadline = deadline # time.time() by which the request must get a worker, if any
+        self.bridge: asyncio.Future = asyncio.get_event_loop().create_future()
+        self.head_since: Optional[float] = None # when the request became number 1 in the queue
+        self.created_at = time.monotonic()
+        self.affinity = affinity # the task and target, workers that have recently run it have its build cached
+        self.queued = False
+        self.tag = 0 # the turn of the request among the requests of its priority
+        self.seq = 0
+        self.position: Optional[int] = None # in the queue, as last told to the waiter
+        self.news: Optional[asyncio.Future] = None # resolved when position, head_since or bridge change
+
+    def notify(self):
+        if self.news is not None and not self.news.done():
+            self.news.set_result(None)
+
+
+class FairQueue:
+    # requests for one build_env, every operation but rank() is O(log n):
+    # * a lower priority value goes first
+    # * within a priority users take turns: a ticket is tagged with the next turn of its user (start-time
+    #   fair queuing), so a user with many requests delays the others by one request per turn at most
+    # * tickets that are URGENT_WINDOW from their deadline go before everything, the earliest deadline first
+    # * a ticket can be taken out of turn by a worker that has recently run its task, see WorkersManager._dispatch
+    # taken and removed tickets stay in the heaps until they come up or the heaps are rebuilt
     def __init__(self):
-        self.workers = []
-        self.bridges = []
-        self.wait_queue: Dict[str, List[str]] = {}
+        self.fair: List[tuple] = [] # (priority, tag, seq, ticket)
+        self.urgent: List[tuple] = [] # (deadline, seq, ticket), tickets with a deadline only
+        self.by_affinity: Dict[str, List[tuple]] = {} # the same entries as in fair, tickets with an affinity only
+        self.affinity_count: Dict[str, int] = {} # queued tickets
+        self.count = 0
+        self.pending: Dict[Tuple[int, str], int] = {} # by (priority, user), queued tickets
+        self.by_priority: Dict[int, int] = {} # queued tickets
+        self.last_tag: Dict[Tuple[int, str], int] = {} # by (priority, user), tag of the user's last queued ticket
+        self.turn: Dict[int, int] = {} # by priority, tag of the last ticket taken in its turn
+        self.seq = itertools.count()
+        self.marked: Optional[Ticket] = None # the ticket whose head_since is set
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, ticket: Ticket):
+        return ticket.queued
+
+    def push(self, ticket: Ticket):
+        key = (ticket.priority, ticket.user)
+        ticket.tag = max(self.last_tag.get(key, 0), self.turn.get(ticket.priority, 0)) + 1
+        ticket.seq = next(self.seq)
+        ticket.queued = True
+        self.last_tag[key] = ticket.tag
+        self.pending[key] = self.pending.get(key, 0) + 1
+        self.by_priority[ticket.priority] = self.by_priority.get(ticket.priority, 0) + 1
+        self.count += 1
+        ticket.position = self.count - 1 # at most that many go before it, until the queue is ranked
+        entry = (ticket.priority, ticket.tag, ticket.seq, ticket)
+        heapq.heappush(self.fair, entry)
+        if ticket.affinity is not None:
+            heapq.heappush(self.by_affinity.setdefault(ticket.affinity, []), entry)
+            self.affinity_count[ticket.affinity] = self.affinity_count.get(ticket.affinity, 0) + 1
+        if ticket.deadline is not None:
+            heapq.heappush(self.urgent, (ticket.deadline, ticket.seq, ticket))
+
+    def pop(self) -> Ticket:
+        return self.take(self.head())
+
+    def take(self, ticket: Ticket) -> Ticket:
+        # the head() ticket or the first() of some affinity
+        in_turn = ticket is self._top(self.fair)
+        self.remove(ticket)
+        if in_turn: # a ticket taken before its turn, e.g. an urgent one, doesn't move the turn of the others
+            self.turn[ticket.priority] = max(self.turn.get(ticket.priority, 0), ticket.tag)
+        return ticket
+
+    def remove(self, ticket: Ticket):
+        ticket.queued = False
+        self.count -= 1
+        key = (ticket.priority, ticket.user)
+        self.pending[key] -= 1
+        if self.pending[key] == 0:
+            del self.pending[key]
+            del self.last_tag[key]
+        self.by_priority[ticket.priority] -= 1
+        if ticket.affinity is not None:
+            self.affinity_count[ticket.affinity] -= 1
+            if self.affinity_count[ticket.affinity] == 0:
+                del self.affinity_count[ticket.affinity]
+        if len(self.fair) > 2 * self.count + 16:
+            self.fair = [e for e in self.fair if e[-1].queued]
+            self.urgent = [e for e in self.urgent if e[-1].queued]
+            heapq.heapify(self.fair)
+            heapq.heapify(self.urgent)
+            by_affinity = {}
+            for affinity, heap in self.by_affinity.items():
+                heap = [e for e in heap if e[-1].queued]
+                if heap:
+                    heapq.heapify(heap)
+                    by_affinity[affinity] = heap
+            self.by_affinity = by_affinity
+
+    def head(self) -> Optional[Ticket]:
+        return self._next()[0]
+
+    def first(self, affinity: str) -> Optional[Ticket]:
+        # the queued ticket of this affinity that goes first in its turn
+        heap = self.by_affinity.get(affinity)
+        ticket = self._top(heap) if heap is not None else None
+        if ticket is None:
+            self.by_affinity.pop(affinity, None)
+        return ticket
+
+    def ahead(self, priority: int) -> int:
+        # how many queued tickets go before a new ticket of this priority, but the urgent ones
+        return sum(n for p, n in self.by_priority.items() if p <= priority)
+
+    def _next(self) -> Tuple[Optional[Ticket], bool]: # returns [ticket, whether it's urgent]
+        urgent = self._top(self.urgent)
+        if urgent is not None and urgent.deadline - time.time() <= URGENT_WINDOW:
+            return urgent, True
+        return self._top(self.fair), False
+
+    @staticmethod
+    def _top(heap: List[tuple]) -> Optional[Ticket]:
+        while heap and not heap[0][-1].queued:
+            heapq.heappop(heap)
+        return heap[0][-1] if heap else None
+
+    def rank(self) -> List[Ticket]:
+        # sets positions of the queued tickets in their turns, returns the tickets whose position has changed noticeably
+        changed = []
+        for i, entry in enumerate(sorted(e for e in self.fair if e[-1].queued)):
+            ticket = entry[-1]
+            if ticket.position is None or abs(ticket.position - i) * POSITION_GRANULARITY >= max(ticket.position, POSITION_GRANULARITY):
+                ticket.position = i
+                changed.append(ticket)
+        return changed
+
 
-    def register(self, worker_id: str, build_env: str):
-        if len(self.workers) > 0 and next(w for w in self.workers if w.worker_id == worker_id) is not None:
-            print(f'Error: worker {worker_id} has alredy been registered')
+class WorkersManager:
+    def __init__(self):
+        self.workers: Dict[str, Worker] = {}
+        # workers that can take one more request, by build_env
+        self.free_workers: Dict[str, WorkerPool] = {}
+        self.bridges: Dict[Tuple[str, str], Bridge] = {} # by (request_id, worker_id)
+        self.wait_queue: Dict[str, FairQueue] = {}
+        self.slots: Dict[str, int] = {} # of the registered workers, by build_env
+        self.run_durations: Dict[str, float] = {} # moving averages of how long a request holds a worker, by build_env
+        # worker_ids that have recently run a task, by ticket.affinity, the least recent first
+        self.warm: collections.OrderedDict = collections.OrderedDict()
+        self.dispatch_timers: Dict[str, asyncio.TimerHandle] = {} # by build_env, while the head waits for a warm worker
+        # queues whose positions have changed since they were last published, for all waiters at once
+        self.changed_queues: Set[str] = set()
+        self.positions_timer: Optional[asyncio.TimerHandle] = None
+        self.positions_published_at = 0.0
+
+    def _update_free(self, worker: Worker):
+        pool = self.free_workers.setdefault(worker.build_env, WorkerPool())
+        pool.update(worker, worker.available() and worker.worker_id in self.workers)
+
+    def build_env_label(self, build_env: str) -> str:
+        # a client can ask for any build_env, only the ones of workers become label values, so the series stay bounded
+        return build_env if build_env in self.slots else OTHER_BUILD_ENV
+
+    def _drop_unserved_queue(self, build_env: str):
+        # a queue is made for any build_env a client asks for, the ones without workers are kept only while requests wait in them
+        queue = self.wait_queue.get(build_env)
+        if queue is not None and len(queue) == 0 and not self.slots.get(build_env):
+            del self.wait_queue[build_env]
+
+    def register(self, worker_id: str, build_env: str, slots: int = 1, flow_control: bool = False):
+        if worker_id in self.workers:
+            logger.error('worker has already been registered', extra=log.fields(worker_id=worker_id))
             return
-        self.workers.append(Worker(worker_id, build_env))
+        worker = Worker(worker_id, build_env, slots, flow_control)
+        self.workers[worker_id] = worker
+        self.slots[build_env] = self.slots.get(build_env, 0) + slots
+        self._update_free(worker)
+        self._dispatch(build_env)
 
     def unregister(self, worker_id: str):
-        worker = next(w for w in self.workers if w.worker_id == worker_id) if len(self.workers) > 0 else None
+        worker = self.workers.pop(worker_id, None)
         if worker is None:
-            print(f'Error: couldn\'t unregister worker {worker_id} with build_env {build_env}')
-
-        self.workers.remove(worker)
+            logger.error('couldn\'t unregister worker', extra=log.fields(worker_id=worker_id))
+            return
+        WORKER_DISCONNECTS.labels(worker.build_env).inc()
+        self.slots[worker.build_env] -= worker.slots
+        self._update_free(worker)
+        self._drop_unserved_queue(worker.build_env)
 
-        bridges = (b for b in self.bridges if b.worker.worker_id == worker_id)
-        for b in bridges:
-            b.disconnect()
+        for b in list(worker.bridges.values()):
+            if b.cancel_timer is not None:
+                self._end_cancel(b, 'disconnected') # nobody waits for the run
+            else:
+                b.disconnect()
 
     # called from /bridge
     async def receive_for_worker(self, worker_id: str) -> str:
+        worker = self.workers[worker_id]
         while True:
-            # find all bridges with the given worker_id
-            bridges = [b for b in self.bridges if b.worker.worker_id == worker_id and not b.msgs_to_worker.empty()]
-            if len(bridges) == 0:
-                await asyncio.sleep(0.05) # TODO: block until event?
-                continue
-
-            # pick a random one and get a message from it's queue
-            bridge = random.choice(bridges)
-            msg = bridge.msgs_to_worker.get_nowait()
-            return msg
+            while len(worker.pending_bridges) > 0:
+                bridge = worker.pending_bridges.popleft()
+                if bridge.worker is None or bridge.msgs_to_worker.empty(): # the bridge has been closed meanwhile
+                    bridge.scheduled = False
+                    continue
+
+                # take one message and put the bridge to the back, so bridges of the worker interleave fairly
+                msg = bridge.take_for_worker()
+                if bridge.msgs_to_worker.empty():
+                    bridge.scheduled = False
+                else:
+                    worker.pending_bridges.append(bridge)
+                return msg
+
+            worker.has_pending.clear()
+            await worker.has_pending.wait()
 
     # called from /bridge
     def send_to_client(self, request_id: str, worker_id: str, msg: str):
-        bridge = next(b for b in self.bridges if b.request_id == request_id and b.worker.worker_id == worker_id) if len(self.bridges) > 0 else None
+        bridge = self.bridges.get((request_id, worker_id))
         if bridge:
+            if bridge.cancel_timer is not None:
+                # the run's client is gone, the output is dropped until the worker confirms it has stopped
+                if envelope.is_finish(msg):
+                    self._end_cancel(bridge, 'confirmed')
+                return
             bridge.send_to_client(msg)
         else:
-            raise Exception('couldn\'t find a bridge between request {request_id} and worker {worker_id}')
+            raise Exception(f'couldn\'t find a bridge between request {request_id} and worker {worker_id}')
 
-    def make_bridge(self, request_id: str, build_env: str) -> Bridge:
-        assert(len(self.wait_queue[build_env]) > 0 and self.wait_queue[build_env][0] == request_id)
-        # pick a random free worker with matching `build_env`
-        if len(self.workers) == 0:
-            return None
-        worker = None
-        shift = random.randint(0, len(self.workers) - 1)
-        for i in range(len(self.workers)):
-            w = self.workers[(i + shift) % len(self.workers)]
-            if w.build_env == build_env and w.available():
-                worker = w
-                break
-        if worker is None:
+    def _make_bridge(self, worker: Worker, request_id: str) -> Bridge:
+        bridge = Bridge(worker, request_id)
+        self.bridges[(request_id, worker.worker_id)] = bridge
+        worker.bridges[request_id] = bridge
+        worker.free_since = time.time()
+        self._update_free(worker)
+        logger.debug('made a bridge', extra=log.fields(request_id=request_id, worker_id=worker.worker_id))
+        return bridge
+
+    # hand free workers to the requests at the head of the queue, called whenever a worker or a request shows up
+    def _dispatch(self, build_env: str):
+        timer = self.dispatch_timers.pop(build_env, None)
+        if timer is not None:
+            timer.cancel()
+        queue = self.wait_queue.get(build_env)
+        pool = self.free_workers.get(build_env)
+        if pool is not None:
+            pool.sync(queue)
+        while queue and pool:
+            ticket = queue.head()
+            worker = self._pick_worker(ticket, queue, pool)
+            if worker is None:
+                # the head waits for a warm worker, meanwhile free workers take the requests they're warm for (delay scheduling)
+                ticket, worker = pool.warm_request(queue)
+                if ticket is not None:
+                    AFFINITY_DISPATCHES.labels(build_env, 'hit').inc()
+                else:
+                    delay = self._affinity_deadline(queue.head(), pool) - time.time()
+                    self.dispatch_timers[build_env] = asyncio.get_event_loop().call_later(delay, self._dispatch, build_env)
+                    break
+            queue.take(ticket)
+            QUEUE_WAIT.labels(build_env).observe(time.monotonic() - ticket.created_at)
+            ticket.bridge.set_result(self._make_bridge(worker, ticket.request_id))
+            self._warm_up(ticket.affinity, worker)
+            ticket.notify()
+            self._positions_changed(build_env)
+        self._mark_head(queue)
+
+    @staticmethod
+    def _affinity_deadline(head: Ticket, pool: WorkerPool) -> float:
+        # time.time() until which the head may wait for a warm worker, and the free workers may stay unused meanwhile,
+        # otherwise a task of a class would stick to the first worker that has run it, head_since is set after this dispatch
+        return min(head.head_since or time.time(), pool.oldest_free_since()) + AFFINITY_WAIT
+
+    def _pick_worker(self, ticket: Ticket, queue: FairQueue, pool: WorkerPool) -> Optional[Worker]:
+        # a free worker that has recently run the head's task, if there is one, None while it's worth waiting for one
+        warm = self.warm.get(ticket.affinity) if ticket.affinity is not None else None
+        if warm:
+            free = [pool.free[worker_id] for worker_id in warm if worker_id in pool.free]
+            if free:
+                AFFINITY_DISPATCHES.labels(ticket.build_env, 'hit').inc()
+                return min(free, key=Worker.load)
+            if time.time() < self._affinity_deadline(ticket, pool):
+                # only if the warm workers alone would run the queued requests of the task in time, not in a burst of them
+                slots = sum(self.workers[worker_id].slots for worker_id in warm if worker_id in self.workers)
+                duration = self.run_durations.get(ticket.build_env)
+                if slots > 0 and duration is not None and queue.affinity_count[ticket.affinity] * duration / slots <= AFFINITY_WAIT:
+                    return None
+            AFFINITY_DISPATCHES.labels(ticket.build_env, 'miss').inc()
+        else:
+            AFFINITY_DISPATCHES.labels(ticket.build_env, 'cold').inc()
+        return pool.least_loaded()
+
+    def _warm_up(self, affinity: Optional[str], worker: Worker):
+        if affinity is None:
+            return
+        warm = self.warm.get(affinity)
+        if warm is None:
+            warm = self.warm[affinity] = collections.OrderedDict()
+            if len(self.warm) > AFFINITY_TASKS:
+                self.warm.popitem(last=False)
+        else:
+            self.warm.move_to_end(affinity)
+        warm[worker.worker_id] = None
+        warm.move_to_end(worker.worker_id)
+        if len(warm) > AFFINITY_WORKERS:
+            warm.popitem(last=False)
+        pool = self.free_workers[worker.build_env]
+        worker.warm_tasks[affinity] = None
+        worker.warm_tasks.move_to_end(affinity)
+        pool.warm_task_added(worker, affinity)
+        if len(worker.warm_tasks) > WORKER_TASKS:
+            pool.warm_task_dropped(worker, worker.warm_tasks.popitem(last=False)[0])
+
+    def _positions_changed(self, build_env: str):
+        # positions are published right away if they haven't been for POSITION_UPDATE_INTERVAL, otherwise when it passes
+        self.changed_queues.add(build_env)
+        if self.positions_timer is None:
+            loop = asyncio.get_event_loop()
+            delay = max(0.0, self.positions_published_at + POSITION_UPDATE_INTERVAL - loop.time())
+            self.positions_timer = loop.call_later(delay, self._publish_positions)
+
+    def _publish_positions(self):
+        self.positions_timer = None
+        self.positions_published_at = asyncio.get_event_loop().time()
+        changed = []
+        for build_env in self.changed_queues:
+            queue = self.wait_queue.get(build_env)
+            if queue is not None:
+                changed.extend(queue.rank())
+        self.changed_queues.clear()
+        _notify_in_chunks(changed)
+
+    def _mark_head(self, queue: Optional[FairQueue]):
+        if queue is None:
+            return
+        head = queue.head()
+        if queue.marked is not head:
+            if queue.marked is not None and queue.marked.queued:
+                queue.marked.head_since = None # overtaken, e.g. by a higher priority, it's not stuck at the head
+                queue.marked.notify()
+            queue.marked = head
+        if head is not None and head.head_since is None:
+            head.head_since = time.time()
+            head.notify()
+
+    # called after bridge.close()
+    def remove_bridge(self, bridge: Bridge):
+        if self.bridges.pop((bridge.request_id, bridge.worker_id), None) is not None:
+            duration = time.monotonic() - bridge.created_at
+            RUN_DURATION.labels(bridge.build_env).observe(duration)
+            average = self.run_durations.get(bridge.build_env, duration)
+            self.run_durations[bridge.build_env] = average + RUN_DURATION_SMOOTHING * (duration - average)
+        worker = self.workers.get(bridge.worker_id)
+        if worker is not None:
+            worker.bridges.pop(bridge.request_id, None)
+            worker.free_since = time.time()
+            self._update_free(worker)
+            self._dispatch(worker.build_env)
+
+    # instead of bridge.close() when the client is gone before the run has finished: the worker is told to stop the run
+    # and the slot stays busy until the worker confirms with `finish` or CANCEL_TIMEOUT passes
+    def cancel(self, bridge: Bridge):
+        if not bridge.started or bridge.disconnected or bridge.worker is None:
+            bridge.close()
+            self.remove_bridge(bridge)
+            return
+        logger.info('cancelling a run', extra=log.fields(request_id=bridge.request_id, worker_id=bridge.worker_id))
+        bridge.discard_to_client()
+        bridge.send_to_worker({'request_id': bridge.request_id, 'command': 'cancel'})
+        bridge.cancel_timer = asyncio.get_event_loop().call_later(CANCEL_TIMEOUT, self._end_cancel, bridge, 'timeout')
+
+    def _end_cancel(self, bridge: Bridge, result: str):
+        bridge.cancel_timer.cancel()
+        CANCELLED_RUNS.labels(result).inc()
+        if result == 'timeout':
+            logger.warning('worker hasn\'t confirmed a cancelled run', extra=log.fields(request_id=bridge.request_id, worker_id=bridge.worker_id))
+        bridge.discard_to_client()
+        bridge.close()
+        self.remove_bridge(bridge)
+
+    def put_in_queue(self, request_id: str, build_env: str, user: str = '', priority: int = DEFAULT_PRIORITY,
+                     deadline: Optional[float] = None, affinity: Optional[str] = None) -> Ticket:
+        ticket = Ticket(request_id, build_env, user, priority, deadline, affinity)
+        queue = self.wait_queue.setdefault(build_env, FairQueue())
+        if MAX_ESTIMATED_WAIT > 0 and not self.free_workers.get(build_env):
+            # shed the load now rather than let the request wait for a worker it wouldn't get in time
+            wait = self._expected_wait(build_env, queue.ahead(priority))
+            if wait is not None and wait > MAX_ESTIMATED_WAIT:
+                REJECTED.labels(build_env).inc()
+                ticket.bridge.set_exception(RejectedError(max(wait - MAX_ESTIMATED_WAIT, MIN_RETRY_AFTER)))
+                return ticket
+        queue.push(ticket)
+        pool = self.free_workers.get(build_env)
+        if pool is not None:
+            pool.queued(ticket)
+        self._dispatch(build_env)
+        if not ticket.bridge.done():
+            self._positions_changed(build_env)
+        return ticket
+
+    # the request has given up waiting, returns its bridge if it was made meanwhile, the caller must close it
+    def leave_queue(self, ticket: Ticket) -> Optional[Bridge]:
+        if ticket.bridge.done() and not ticket.bridge.cancelled() and ticket.bridge.exception() is None:
+            return ticket.bridge.result()
+        queue = self.wait_queue.get(ticket.build_env)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            self._mark_head(queue)
+            self._positions_changed(ticket.build_env)
+            self._drop_unserved_queue(ticket.build_env)
+        ticket.bridge.cancel()
+        return None
+
+    # queue sizes of every bridge, for monitoring
+    def bridges_stats(self) -> List[dict]:
+        return [b.stats() for b in self.bridges.values()]
+
+    # gauges of /metrics, read on every scrape
+    def collect_metrics(self):
+        for family in (WORKERS, WORKER_SLOTS, BUSY_SLOTS, UTILISATION, QUEUE_DEPTH):
+            family.clear()
+        for worker in self.workers.values():
+            WORKERS.labels(worker.build_env).value += 1
+            WORKER_SLOTS.labels(worker.build_env).value += worker.slots
+            BUSY_SLOTS.labels(worker.build_env).value += worker.busy_factor
+        for (build_env,), slots in WORKER_SLOTS.children.items():
+            UTILISATION.labels(build_env).set(BUSY_SLOTS.labels(build_env).value / slots.value)
+        for build_env, queue in self.wait_queue.items():
+            QUEUE_DEPTH.labels(self.build_env_label(build_env)).value += len(queue)
+
+        BRIDGES.labels().set(len(self.bridges))
+        to_worker = sum(b.msgs_to_worker.qsize() for b in self.bridges.values())
+        to_client = sum(b.msgs_to_client.qsize() for b in self.bridges.values())
+        BRIDGE_QUEUED_MESSAGES.labels('to_worker').set(to_worker)
+        BRIDGE_QUEUED_MESSAGES.labels('to_client').set(to_client)
+        BRIDGE_QUEUED_BYTES.labels('to_worker').set(sum(b.bytes_to_worker for b in self.bridges.values()))
+        BRIDGE_QUEUED_BYTES.labels('to_client').set(sum(b.bytes_to_client for b in self.bridges.values()))
+
+    # what position the client is in the queue? None until positions are published
+    def queue_number(self, ticket: Ticket) -> Optional[int]:
+        return ticket.position
+
+    def _expected_wait(self, build_env: str, ahead: int) -> Optional[float]:
+        # in seconds, until `ahead` requests and then one more get a worker, None with nothing to estimate it from
+        duration = self.run_durations.get(build_env)
+        slots = self.slots.get(build_env, 0)
+        if duration is None or slots <= 0:
             return None
+        return (ahead + 1) * duration / slots
 
-        # create a bridge instance
-        bridge = Bridge(worker, request_id)
-        self.bridges.append(bridge)
+    # how long the client is likely to wait for a worker, None if it can't be estimated yet
+    def estimated_wait(self, ticket: Ticket) -> Optional[float]:
+        if ticket.position is None:
+            return None
+        return self._expected_wait(ticket.build_env, ticket.position)
 
-        # remove the request from a wait queue
-        assert(len(self.wait_queue[build_env]) > 0 and self.wait_queue[build_env].index(request_id) == 0)
-        self.wait_queue[build_env].remove(request_id)
 
-        print(f'Made a bridge from {request_id} to {worker.worker_id}')
-        return bridge
+def _notify_in_chunks(tickets: List[Ticket], start: int = 0):
+    for ticket in tickets[start:start + NOTIFY_CHUNK]:
+        ticket.notify()
+    if start + NOTIFY_CHUNK < len(tickets):
+        asyncio.get_event_loop().call_soon(_notify_in_chunks, tickets, start + NOTIFY_CHUNK)
 
-    def remove_bridge(self, bridge: Bridge):
-        self.bridges.remove(bridge)
-    
-    def put_in_queue(self, request_id: str, build_env: str):
-        if build_env not in self.wait_queue:
-            self.wait_queue[build_env] = [request_id]
-        else:
-            self.wait_queue[build_env].append(request_id)
 
-    # what position the client is in the queue?
-    def queue_number(self, request_id: str, build_env: str):
-        return self.wait_queue[build_env].index(request_id)
+async def wait_for_ticket(ticket, timeout: Optional[float]):
+    # until the ticket gets a bridge, its position or head_since change, or the timeout
+    if ticket.bridge.done():
+        return
+    ticket.news = asyncio.get_event_loop().create_future()
+    try:
+        await asyncio.wait_for(ticket.news, timeout)
+    except asyncio.TimeoutError:
+        pass
 
 
 instance = WorkersManager()
 
 def manager():
     return instance
+
+metrics.add_collector(lambda: manager().collect_metrics())
@@ -1,4 +1,17 @@
+import os
+import subprocess
+import sys
 import uvicorn
 
 if __name__ == "__main__":
-    uvicorn.run("practicode_backend.asgi:application", host="127.0.0.1", port=8000, log_level="info", reload=True, ws_ping_interval=2.0)
+    processes = int(os.getenv("BACKEND_PROCESSES", "1"))
+    if processes == 1:
+        uvicorn.run("practicode_backend.asgi:application", host="127.0.0.1", port=8000, log_level="info", reload=True, ws_ping_interval=2.0)
+    else:
+        # the processes share workers and queues through a broker hub
+        broker_socket = os.environ.setdefault("BROKER_SOCKET", "/tmp/practicode-broker.sock")
+        hub = subprocess.Popen([sys.executable, "-m", "practicode_backend.broker", broker_socket])
+        try:
+            uvicorn.run("practicode_backend.asgi:application", host="127.0.0.1", port=8000, log_level="info", workers=processes, ws_ping_interval=2.0)
+        finally:
+            hub.terminate()